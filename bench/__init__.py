@@ -0,0 +1,7 @@
+"""性能基准测试
+
+python -m bench                             # 运行全部
+python -m bench add_channel_uri export      # 仅运行指定项
+python -m bench --lines 500000 --epg-size 1024 --output result.json
+python -m bench --compare base.json result.json
+"""
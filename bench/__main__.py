@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import importlib
+import statistics
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+
+from bench.generate import ROOT, write_source, write_xmltv
+from bench.server import LocalServer
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """注册基准测试, 被装饰的函数完成准备工作并返回 (执行函数, 处理的数量), 数量为线路数, EPG为MB"""
+    def _wrap(func):
+        BENCHMARKS[name] = func
+        return func
+    return _wrap
+
+
+class Context:
+    def __init__(self, args, workdir, server):
+        self.args = args
+        self.workdir = workdir
+        self.server = server
+        self.dist = os.path.join(workdir, 'dist')
+        self.cache = os.path.join(workdir, 'cache')
+        self.sources = []
+        self.entries = []
+
+    @property
+    def iptv(self):
+        return importlib.import_module('iptv')
+
+    @property
+    def epg(self):
+        return importlib.import_module('epg')
+
+    def reset_output(self):
+        for path in [self.dist, self.cache]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def new_iptv(self):
+        iptv = self.iptv.IPTV()
+        iptv.load_channels()
+        return iptv
+
+    def ingested_iptv(self):
+        iptv = self.new_iptv()
+        for name, uri, attrs in self.entries:
+            iptv.add_channel_uri(name, uri, attrs)
+        return iptv
+
+
+def prepare(args, workdir):
+    """生成数据并启动本地服务, 之后才能导入iptv/epg, 因其在导入时读取环境变量"""
+    data = os.path.join(workdir, 'data')
+    os.makedirs(data, exist_ok=True)
+    source_kwargs = dict(lines=args.lines // args.sources, dup_rate=args.dup_rate, trad_rate=args.trad_rate,
+                         ipv6_rate=args.ipv6_rate, unwanted_rate=args.unwanted_rate)
+    sources = []
+    for i in range(args.sources):
+        fmt = 'm3u' if i % 2 == 0 else 'txt'
+        filename = f'source{i}.{fmt}'
+        write_source(os.path.join(data, filename), fmt=fmt, seed=args.seed + i, **source_kwargs)
+        sources.append(filename)
+    write_xmltv(os.path.join(data, 'epg.xml.gz'), size_mb=args.epg_size, seed=args.seed)
+
+    server = LocalServer(data).start()
+    config = os.path.join(workdir, 'bench.ini')
+    with open(config, 'w') as fp:
+        fp.write('[config]\nprobe = false\nsource =\n')
+        for filename in sources:
+            fp.write(f'    {server.url(filename)}\n')
+
+    ctx = Context(args, workdir, server)
+    os.environ.update({
+        'IPTV_CONFIG': f'{os.path.join(ROOT, "config.ini")},{config}',
+        'IPTV_CHANNEL': os.path.join(ROOT, 'channel.txt'),
+        'IPTV_DIST': ctx.dist,
+        'IPTV_CACHE': ctx.cache,
+        'EPG_SOURCE': server.url('epg.xml.gz'),
+        'EXPORT_RAW': 'false',
+        'EXPORT_JSON': 'false',
+    })
+    os.chdir(ROOT)
+    if not args.verbose:
+        # iptv导入时会配置logging
+        ctx.iptv
+        logging.disable(logging.CRITICAL)
+
+    from source import parse_source
+    for filename in sources:
+        with open(os.path.join(data, filename), 'rb') as fp:
+            ctx.entries.extend(parse_source(fp)[2])
+    ctx.sources = sources
+    return ctx
+
+
+@benchmark('clean_channel_name')
+def bench_clean_channel_name(ctx):
+    iptv = ctx.iptv.IPTV()
+    names = [name for name, _, _ in ctx.entries]
+    return lambda: [iptv.clean_channel_name(n) for n in names], len(names)
+
+
+@benchmark('add_channel_uri')
+def bench_add_channel_uri(ctx):
+    ctx.reset_output()
+    iptv = ctx.new_iptv()
+
+    def _run():
+        for name, uri, attrs in ctx.entries:
+            iptv.add_channel_uri(name, uri, attrs)
+    return _run, len(ctx.entries)
+
+
+@benchmark('export')
+def bench_export(ctx):
+    ctx.reset_output()
+    iptv = ctx.ingested_iptv()
+    return iptv.export, sum(len(v) for v in iptv.channels.values())
+
+
+@benchmark('fetch_sources')
+def bench_fetch_sources(ctx):
+    ctx.reset_output()
+    iptv = ctx.new_iptv()
+    return iptv.fetch_sources, len(ctx.entries)
+
+
+@benchmark('epg_stream')
+def bench_epg_stream(ctx):
+    ctx.reset_output()
+    epg = ctx.epg.EPG()
+
+    def _run():
+        if not epg.run_stream():
+            raise RuntimeError('EPG流式处理失败')
+        epg.export_index()
+    return _run, ctx.args.epg_size
+
+
+@benchmark('epg_tree')
+def bench_epg_tree(ctx):
+    ctx.reset_output()
+    epg = ctx.epg.EPG()
+
+    def _run():
+        epg.fetch_epg()
+        if epg.epg_doc is None:
+            raise RuntimeError('EPG获取失败')
+        epg.normalize()
+        epg.export()
+        epg.export_index()
+    return _run, ctx.args.epg_size
+
+
+def run_benchmark(ctx, name):
+    func = BENCHMARKS[name]
+    times = []
+    for _ in range(ctx.args.repeat):
+        run, items = func(ctx)
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    peak = None
+    if not ctx.args.no_memory:
+        # 单独运行一次统计内存, tracemalloc会明显拖慢执行
+        run, items = func(ctx)
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    best = min(times)
+    return OrderedDict([
+        ('repeat', len(times)),
+        ('times', [round(t, 4) for t in times]),
+        ('min', round(best, 4)),
+        ('median', round(statistics.median(times), 4)),
+        ('items', items),
+        ('items_per_second', round(items / best, 1) if best > 0 else None),
+        ('peak_memory', peak),
+    ])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(base_path, new_path):
+    with open(base_path) as fp:
+        base = json.load(fp)['results']
+    with open(new_path) as fp:
+        new = json.load(fp)['results']
+    print(f'{"benchmark":<20} {"base":>10} {"new":>10} {"ratio":>8} {"memory":>8}')
+    for name, r in new.items():
+        if name not in base:
+            continue
+        b = base[name]
+        ratio = r['min'] / b['min'] if b['min'] else float('nan')
+        mem = (r['peak_memory'] / b['peak_memory']) if r.get('peak_memory') and b.get('peak_memory') else float('nan')
+        print(f'{name:<20} {b["min"]:>10.4f} {r["min"]:>10.4f} {ratio:>8.2f} {mem:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='性能基准测试')
+    parser.add_argument('names', nargs='*', help=f'要运行的基准测试, 默认全部: {", ".join(BENCHMARKS)}')
+    parser.add_argument('--lines', type=int, default=100000, help='所有源的线路总数')
+    parser.add_argument('--sources', type=int, default=4, help='源的数量, M3U及TXT交替')
+    parser.add_argument('--dup-rate', type=float, default=0.3)
+    parser.add_argument('--trad-rate', type=float, default=0.2)
+    parser.add_argument('--ipv6-rate', type=float, default=0.1)
+    parser.add_argument('--unwanted-rate', type=float, default=0.3)
+    parser.add_argument('--epg-size', type=float, default=10, help='XMLTV未压缩大小, MB')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='不统计内存峰值')
+    parser.add_argument('--workdir', help='数据及输出目录, 默认使用临时目录并在结束后删除')
+    parser.add_argument('--output', help='结果输出的JSON文件, 默认输出到标准输出')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='比较两次运行的结果')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    names = args.names or list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f'未知的基准测试: {", ".join(unknown)}')
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='iptv-bench-')
+    ctx = prepare(args, workdir)
+    results = OrderedDict()
+    try:
+        for name in names:
+            print(f'运行: {name}', file=sys.stderr)
+            results[name] = run_benchmark(ctx, name)
+            print(f'  {results[name]["min"]:.4f}s', file=sys.stderr)
+    finally:
+        ctx.server.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    data = OrderedDict([
+        ('meta', OrderedDict([
+            ('time', datetime.now().astimezone().isoformat(timespec='seconds')),
+            ('commit', git_commit()),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('cpu_count', os.cpu_count()),
+            # 整个进程的最大常驻内存, Linux下为KB
+            ('max_rss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+            ('params', {k: v for k, v in vars(args).items() if k not in ['names', 'output', 'compare', 'verbose']}),
+        ])),
+        ('results', results),
+    ])
+    output = json.dumps(data, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
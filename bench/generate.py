@@ -0,0 +1,133 @@
+import os
+import gzip
+import random
+import datetime
+
+import zhconv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 源中常见的频道名写法
+_name_variants = ['{}', '{} HD', '{}高清', '{}-HD', ' {} ', '{}[超清]']
+
+
+def load_channel_names(path=os.path.join(ROOT, 'channel.txt')):
+    names = []
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if line and not line.startswith(('#', 'CATE:', '-')):
+                names.append(line)
+    return names
+
+
+def make_name_pool(names, trad_rate, unwanted_rate, rnd):
+    """返回生成频道名的函数, 按比例混入繁体及不在频道列表中的名称"""
+    trad_names = {n: zhconv.convert(n, 'zh-hk') for n in names}
+
+    def _name():
+        if rnd.random() < unwanted_rate:
+            return f'未知频道{rnd.randint(0, 5000)}'
+        name = rnd.choice(names)
+        if rnd.random() < trad_rate:
+            name = trad_names[name]
+        if name.startswith('CCTV') and rnd.random() < 0.5:
+            name = name.replace('CCTV', 'CCTV-', 1)
+        return rnd.choice(_name_variants).format(name)
+    return _name
+
+
+def gen_source_lines(lines=100000, fmt='m3u', dup_rate=0.3, trad_rate=0.2, ipv6_rate=0.1,
+                     unwanted_rate=0.3, seed=1, names=None):
+    """生成模拟的直播源, 逐行返回
+
+    dup_rate: 复用已生成线路地址的比例
+    trad_rate: 繁体频道名的比例
+    ipv6_rate: IPv6线路的比例
+    unwanted_rate: 不在频道列表中的频道的比例
+    """
+    rnd = random.Random(seed)
+    name_of = make_name_pool(names or load_channel_names(), trad_rate, unwanted_rate, rnd)
+    issued = []
+
+    if fmt == 'm3u':
+        yield '#EXTM3U'
+    else:
+        cates = ['央视频道', '卫视频道', '其它频道']
+    for i in range(lines):
+        if issued and rnd.random() < dup_rate:
+            name, uri = rnd.choice(issued)
+        else:
+            name = name_of()
+            if rnd.random() < ipv6_rate:
+                host = f'[2409:8087:{rnd.randint(0, 0xffff):x}::{rnd.randint(1, 0xff):x}]'
+            else:
+                host = f'h{rnd.randint(0, 20000)}.example.com'
+            port = rnd.choice(['', '', ':80', ':8080'])
+            uri = f'http://{host}{port}/live/{i}/index.m3u8'
+            if rnd.random() < 0.05:
+                uri = f'{uri}$线路{rnd.randint(1, 9)}'
+            issued.append((name, uri))
+        if fmt == 'm3u':
+            yield (f'#EXTINF:-1 tvg-id="{i}" tvg-name="{name.strip()}" '
+                   f'tvg-logo="https://logo.example.com/{i}.png" group-title="频道",{name}')
+            yield uri
+        else:
+            if i % 1000 == 0:
+                yield f'{cates[i // 1000 % len(cates)]},#genre#'
+            yield f'{name},{uri}'
+
+
+def write_source(path, **kwargs):
+    with open(path, 'w', encoding='utf-8') as fp:
+        for line in gen_source_lines(**kwargs):
+            fp.write(line)
+            fp.write('\n')
+    return path
+
+
+def gen_xmltv_chunks(size_mb=10, channels=None, extra_channels=200, seed=1, tz='+0800'):
+    """生成模拟的XMLTV, 未压缩大小约为size_mb, 逐块返回字符串
+
+    节目以当天为中心, 覆盖前后数天, 以便测试时间窗口
+    """
+    rnd = random.Random(seed)
+    names = list(channels or load_channel_names()) + [f'无关频道{i}' for i in range(extra_channels)]
+    limit = int(size_mb * 1024 * 1024)
+    size = 0
+
+    def _chunk(s):
+        nonlocal size
+        size += len(s.encode())
+        return s
+
+    yield _chunk('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<tv generator-info-name="bench" generator-info-url="http://127.0.0.1/">\n')
+    for i, name in enumerate(names):
+        yield _chunk(f'  <channel id="{i}">\n    <display-name lang="zh">{name}</display-name>\n  </channel>\n')
+
+    start = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=3), datetime.time())
+    slot = 0
+    while size < limit:
+        # 各频道依次生成同一时段的节目
+        begin = start + datetime.timedelta(minutes=30 * slot)
+        end = begin + datetime.timedelta(minutes=30)
+        begin_s, end_s = begin.strftime('%Y%m%d%H%M%S'), end.strftime('%Y%m%d%H%M%S')
+        parts = []
+        for i in range(len(names)):
+            n = rnd.randint(1, 99)
+            parts.append(f'  <programme start="{begin_s} {tz}" stop="{end_s} {tz}" channel="{i}">\n'
+                         f'    <title lang="zh">节目 &amp; 第{n}集</title>\n'
+                         f'    <desc lang="zh">{"模拟节目简介" * rnd.randint(1, 8)}</desc>\n'
+                         f'  </programme>\n')
+        yield _chunk(''.join(parts))
+        slot += 1
+    yield _chunk('</tv>\n')
+
+
+def write_xmltv(path, compress=None, **kwargs):
+    opener = gzip.open if compress or path.endswith('.gz') else open
+    with opener(path, 'wt', encoding='utf-8') as fp:
+        for chunk in gen_xmltv_chunks(**kwargs):
+            fp.write(chunk)
+    return path
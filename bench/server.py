@@ -0,0 +1,62 @@
+import os
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        # 以文件修改时间作为ETag, 以便测试条件请求
+        if self.command == 'GET' and getattr(self, '_etag', None):
+            self.send_header('ETag', self._etag)
+        super().end_headers()
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        try:
+            st = os.stat(path)
+            self._etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+        except OSError:
+            self._etag = None
+        if self._etag and self.headers.get('If-None-Match') == self._etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        return super().send_head()
+
+
+class LocalServer:
+    """本地HTTP服务, 代替远程源, 用于测试获取相关的流程"""
+
+    def __init__(self, root, host='127.0.0.1', port=0):
+        self.httpd = ThreadingHTTPServer((host, port), partial(QuietHandler, directory=root))
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def url(self, filename):
+        return f'{self.base_url}/{filename}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from iptv import IPTV, logging, conv_bool
+from epg import EPG, EPG_SOURCES
+
+# 仅为获取到线路的频道生成节目表, 直播源生成失败时仍使用全部频道
+BUILD_EPG_AVAILABLE_ONLY = conv_bool(os.environ.get('BUILD_EPG_AVAILABLE_ONLY') or 'true')
+
+
+def build():
+    """在同一进程中生成直播源及EPG, 频道仅加载一次, EPG在获取直播源期间下载
+    其中之一出错时仍生成另一个, 结束后抛出首个错误, 以便以非0状态退出
+    """
+    iptv = IPTV()
+    with iptv.metrics.timer('load'):
+        iptv.load_channels()
+    epg = EPG(iptv=iptv)
+    # 在主线程中初始化, 下载线程中仅使用
+    iptv.session
+    iptv.http_cache
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(len(EPG_SOURCES), 1)) as executor:
+        epg.prefetch(executor)
+        try:
+            iptv.build()
+        except Exception as e:
+            logging.error(f'生成直播源出错: {e}')
+            errors.append(e)
+        else:
+            if BUILD_EPG_AVAILABLE_ONLY:
+                epg.channels = {k: v for k, v in iptv.channels.items() if v}
+        try:
+            epg.build()
+        except Exception as e:
+            logging.error(f'生成EPG出错: {e}')
+            errors.append(e)
+
+    iptv.export_metrics()
+    iptv.prune_cache()
+    if errors:
+        raise errors[0]
+
+
+if __name__ == '__main__':
+    build()
@@ -1,36 +1,201 @@
 import os
+import re
 import xml.etree.ElementTree as ET
 import datetime
 import gzip
+import json
+import hashlib
+import bisect
+import time
+import shutil
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pprint import pprint
 from io import StringIO, BytesIO
 
-from iptv import IPTV, logging, conv_dict, clean_inline_comment
+from iptv import IPTV, logging, conv_bool, conv_dict, clean_inline_comment, OUTPUT_COMPRESS, DEF_CHUNK_SIZE
 
 EPG_GZ_DISABLED = os.environ.get('EPG_GZ_DISABLED') or False
+EPG_GZ_LEVEL = int(os.environ.get('EPG_GZ_LEVEL') or 9)
+# 缩进仅为便于阅读, 关闭可减小文件尺寸
+EPG_INDENT = conv_bool(os.environ.get('EPG_INDENT') or 'true')
+# 禁用流式处理, 整个节目表读入内存后处理
+EPG_STREAM_DISABLED = os.environ.get('EPG_STREAM_DISABLED') or False
+# 多个源以逗号分隔, 按优先级排列
 EPG_SOURCE = os.environ.get('EPG_SOURCE') or 'http://epg.51zmt.top:8000/e.xml.gz'
+EPG_SOURCES = [s.strip() for s in EPG_SOURCE.split(',') if s.strip()]
+# 多源合并时每个频道的主源选择方式: coverage 节目覆盖时长最长 priority 按源顺序
+EPG_MERGE = os.environ.get('EPG_MERGE') or 'coverage'
 EPG_CHANNEL_MAP = os.environ.get('EPG_CHANNEL_MAP') or 'epg.txt'
+# 节目时间窗口 "之前天数,之后天数", 如 "1,3" 为昨天0点至3天后24点, 为空则不限制
+EPG_WINDOW = os.environ.get('EPG_WINDOW') or ''
+# 计算时间窗口日期边界所用时区
+EPG_WINDOW_TZ = os.environ.get('EPG_WINDOW_TZ') or '+0800'
+# 每个频道最多保留的节目数, 从当前节目起计算, 已结束的节目不保留, 0为不限制
+EPG_CHANNEL_LIMIT = int(os.environ.get('EPG_CHANNEL_LIMIT') or 0)
+# 节目子节点保留策略, 逗号分隔, 设置EPG_KEEP_FIELDS时仅保留其中的子节点
+EPG_KEEP_FIELDS = [f.strip() for f in (os.environ.get('EPG_KEEP_FIELDS') or '').split(',') if f.strip()]
+EPG_DROP_FIELDS = [f.strip() for f in os.environ.get('EPG_DROP_FIELDS', 'desc').split(',') if f.strip()]
+# 禁用按频道按天分片的JSON索引 dist/epg/
+EPG_INDEX_DISABLED = os.environ.get('EPG_INDEX_DISABLED') or False
 
 _info_name_keys = ['generator-info-name', 'info-name', 'source-info-name']
 _info_url_keys = ['generator-info-url', 'info-url', 'source-info-url']
 
+_re_xmltv_time = re.compile(r'(\d{4})(\d{2})(\d{2})(\d{2})?(\d{2})?(\d{2})?\s*(?:([+-])(\d{2}):?(\d{2}))?')
+_epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+@functools.lru_cache(maxsize=65536)
+def parse_xmltv_time(value):
+    """XMLTV时间 YYYYmmddHHMMSS +HHMM 转为时间戳, 时分秒及时区可省略"""
+    m = _re_xmltv_time.match(value.strip())
+    if not m:
+        return None
+    y, mo, d, h, mi, se, sign, tz_h, tz_m = m.groups()
+    try:
+        days = datetime.date(int(y), int(mo), int(d)).toordinal() - _epoch_ordinal
+    except ValueError:
+        return None
+    seconds = days * 86400 + int(h or 0) * 3600 + int(mi or 0) * 60 + int(se or 0)
+    if sign:
+        offset = int(tz_h) * 3600 + int(tz_m) * 60
+        seconds -= offset if sign == '+' else -offset
+    return seconds
+
+def strip_whitespace(ele):
+    # 移除仅用于格式化的空白
+    if len(ele) and ele.text is not None and not ele.text.strip():
+        ele.text = None
+    for child in ele:
+        strip_whitespace(child)
+        if child.tail is not None and not child.tail.strip():
+            child.tail = None
+
+class EPGIndex:
+    """按频道按天分片的节目索引, 开始/结束时间为时间戳并以平行数组存储, 便于二分查找"""
+
+    def __init__(self, tz=EPG_WINDOW_TZ):
+        self.tz = tz
+        # 所在时区1970-01-01 0点的时间戳, 即时区偏移的相反数
+        self.offset = parse_xmltv_time(f'19700101000000 {tz}')
+        self.shards = {}        # (频道名, 天) => (开始, 结束, 标题)
+
+    def add(self, name, ele):
+        start = parse_xmltv_time(ele.get('start', ''))
+        if start is None:
+            return
+        stop = parse_xmltv_time(ele.get('stop', '')) or start
+        title = ele.find('title')
+        self.add_programme(name, start, stop, title.text or '' if title is not None else '')
+
+    def add_programme(self, name, start, stop, title):
+        day = (start - self.offset) // 86400
+        shard = self.shards.setdefault((name, day), ([], [], []))
+        shard[0].append(start)
+        shard[1].append(stop)
+        shard[2].append(title)
+
+    def export(self, iptv):
+        # 经 OutputFile 写入, 内容未改变时不覆盖, 并记录到输出清单
+        manifest = {'tz': self.tz, 'channels': {}}
+        files = set()
+        for (name, day), (starts, stops, titles) in sorted(self.shards.items()):
+            date = (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).strftime('%Y%m%d')
+            order = sorted(range(len(starts)), key=starts.__getitem__)
+            data = {
+                'channel': name,
+                'date': date,
+                'start': [starts[i] for i in order],
+                'stop': [stops[i] for i in order],
+                'title': [titles[i] for i in order]
+            }
+            # mtime固定, 内容不变时文件不变
+            body = gzip.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode(), mtime=0)
+            path = f'epg/{name.replace("/", "_")}/{date}.json.gz'
+            dst = iptv.get_dist(path)
+            with iptv.open_output(dst, compress=[]) as fp:
+                fp.write(body)
+            files.add(os.path.abspath(dst))
+            manifest['channels'].setdefault(name, {})[date] = {
+                'path': path,
+                'size': len(body),
+                'sha256': hashlib.sha256(body).hexdigest(),
+                'count': len(order),
+                'start': data['start'][0],
+                'stop': max(data['stop'])
+            }
+
+        dst = iptv.get_dist('epg/manifest.json')
+        with iptv.open_output(dst, compress=[]) as fp:
+            fp.write(json.dumps(manifest, ensure_ascii=False, separators=(',', ':')))
+        files.add(os.path.abspath(dst))
+
+        # 移除过期的分片
+        root = os.path.dirname(os.path.abspath(dst))
+        for dirpath, _, filenames in os.walk(root, topdown=False):
+            for f in filenames:
+                if os.path.join(dirpath, f) not in files:
+                    os.remove(os.path.join(dirpath, f))
+                    iptv.output_manifest.remove(os.path.join(dirpath, f))
+            if dirpath != root and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        iptv.save_output_manifest()
+        logging.info(f'导出EPG索引: {dst} 分片: {len(self.shards)}')
+
 class EPG:
-    def __init__(self, *args, **kwargs):
-        self.iptv = IPTV()
-        self.iptv.load_channels()
+    def __init__(self, *args, iptv=None, **kwargs):
+        # 可与直播源共用同一实例, 此时频道已加载
+        if iptv is None:
+            iptv = IPTV()
+            iptv.load_channels()
+        self.iptv = iptv
+        # 需要节目表的频道, 默认为频道列表中的全部频道
+        self.channels = self.iptv.channels
+        # 地址 => 下载到临时文件的Future
+        self._prefetched = {}
 
         self.epg_doc = None
+        self.window = self.get_window()
+        self.now = int(time.time())
+        self._programme_counts = {}
+        self.index = None if EPG_INDEX_DISABLED else EPGIndex()
+
+    def prefetch(self, executor):
+        """在后台将各源下载到临时文件, 之后的解析直接读取, 以便与直播源的获取并行"""
+        for url in EPG_SOURCES:
+            self._prefetched[url] = executor.submit(self.download, url)
+
+    def download(self, url):
+        start = time.monotonic()
+        fp = tempfile.TemporaryFile()
+        try:
+            with self.iptv.fetch_stream(url) as stream:
+                shutil.copyfileobj(stream, fp, DEF_CHUNK_SIZE)
+        except Exception:
+            fp.close()
+            raise
+        fp.seek(0)
+        self.iptv.metrics.add_time('epg_download', time.monotonic() - start)
+        logging.info(f'EPG下载完毕: {url}')
+        return fp
+
+    def open_source(self, url):
+        future = self._prefetched.pop(url, None)
+        return future.result() if future is not None else self.iptv.fetch_stream(url)
 
     def fetch_epg(self):
-        url = EPG_SOURCE
+        url = EPG_SOURCES[0]
         try:
-            res = self.iptv.fetch(url)
+            with self.open_source(url) as fp:
+                data = fp.read()
             logging.info(f'EPG获取成功: {url}')
             try:
-                content = gzip.decompress(res.content)
+                content = gzip.decompress(data)
                 logging.info('EPG解压成功')
             except:
-                content = res.content
+                content = data
             self.epg_doc = ET.parse(BytesIO(content))
         except Exception as e:
             logging.error(f'解析EPG出错: {url} {e}')
@@ -55,37 +220,77 @@ class EPG:
                 logging.debug(f'映射频道名: {ele.text} => {map_[ele.text]}')
                 ele.text = map_[ele.text]
 
+    def get_window(self):
+        # 返回: (开始时间戳, 结束时间戳) 或 None
+        if not EPG_WINDOW:
+            return None
+        try:
+            before, after = [int(v) for v in EPG_WINDOW.split(',')]
+        except ValueError:
+            logging.error(f'EPG时间窗口配置错误: {EPG_WINDOW}')
+            return None
+        offset = parse_xmltv_time(f'19700101000000 {EPG_WINDOW_TZ}')
+        now = int(datetime.datetime.now(datetime.UTC).timestamp())
+        # 所在时区的当天0点
+        today = (now - offset) // 86400 * 86400 + offset
+        return today - before * 86400, today + (after + 1) * 86400
+
+    def filter_programme(self, ele, key=None):
+        """按时间窗口 每频道数量 子节点策略处理节目, 返回是否保留"""
+        if self.window:
+            start = parse_xmltv_time(ele.get('start', ''))
+            stop = parse_xmltv_time(ele.get('stop', '')) or start
+            if start is not None and (stop <= self.window[0] or start >= self.window[1]):
+                return False
+        if key is not None and EPG_CHANNEL_LIMIT > 0:
+            # 保留当前及之后的节目, 而非源中靠前的过去的节目
+            start = parse_xmltv_time(ele.get('start', ''))
+            stop = parse_xmltv_time(ele.get('stop', '')) or start
+            if stop is not None and stop <= self.now:
+                return False
+            count = self._programme_counts.get(key, 0)
+            if count >= EPG_CHANNEL_LIMIT:
+                return False
+            self._programme_counts[key] = count + 1
+        for child in list(ele):
+            if EPG_KEEP_FIELDS:
+                if child.tag not in EPG_KEEP_FIELDS:
+                    ele.remove(child)
+            elif child.tag in EPG_DROP_FIELDS:
+                ele.remove(child)
+        return True
+
     def cleanup(self):
-        del_channel_ids = []
+        reserved_channel_ids = {}
         reserved_channel_names = []
         root = self.epg_doc.getroot()
+        channels = []
         for channel in root.findall('channel'):
             ele = channel.find('display-name')
             name = ele.text
-            if name not in self.iptv.channels.keys():
-                del_channel_ids.append(channel.get('id'))
-                root.remove(channel)
-            else:
+            if name in self.channels:
+                reserved_channel_ids[channel.get('id')] = name
                 reserved_channel_names.append(name)
+                channels.append(channel)
 
-        for programme in root.findall('programme'):
-            if programme.get('channel') in del_channel_ids:
-                root.remove(programme)
-            else:
-                desc = programme.find('desc')
-                if desc is not None:
-                    programme.remove(desc)
+        programmes = [p for p in root.findall('programme')
+                      if p.get('channel') in reserved_channel_ids and self.filter_programme(p, p.get('channel'))]
+        # 重建子节点列表, 避免逐个 remove
+        root[:] = channels + programmes
+        if self.index is not None:
+            for p in programmes:
+                self.index.add(reserved_channel_ids[p.get('channel')], p)
 
-        non_existed_channels = ', '.join([n for n in self.iptv.channels.keys() if n not in reserved_channel_names])
+        non_existed_channels = ', '.join([n for n in self.channels.keys() if n not in reserved_channel_names])
         logging.info(f'没有节目表的频道: {non_existed_channels}')
 
-    def normalize_extras(self):
-        def _existing_value(ele, try_keys):
+    def normalize_attrib(self, attrib, url=None):
+        def _existing_value(try_keys):
             if not isinstance(try_keys, list):
                 try_keys = [try_keys]
             for k in try_keys:
-                if ele.get(k):
-                    return root.get(k)
+                if attrib.get(k):
+                    return attrib.get(k)
 
         def _normalize(n, u):
             # 51zmt name url 信息写反
@@ -93,52 +298,299 @@ class EPG:
                 n, u = u, n
             return n, u
 
-        root = self.epg_doc.getroot()
-        info_name = _existing_value(root, _info_name_keys)
-        info_url = _existing_value(root, _info_url_keys)
+        info_name = _existing_value(_info_name_keys)
+        info_url = _existing_value(_info_url_keys)
 
         info_name, info_url = _normalize(info_name, info_url)
 
-        root.attrib.clear()
         now = datetime.datetime.now(datetime.UTC)
-        root.set('date', now.strftime('%Y%m%d%H%M%S +0000'))
-        root.set('generator-info-name', 'JinnLynn/iptv')
-        root.set('generator-info-url', 'https://github.com/JinnLynn/iptv')
-        root.set('source-info-name', info_name)
-        root.set('source-info-url', info_url or EPG_SOURCE)
+        return {
+            'date': now.strftime('%Y%m%d%H%M%S +0000'),
+            'generator-info-name': 'JinnLynn/iptv',
+            'generator-info-url': 'https://github.com/JinnLynn/iptv',
+            'source-info-name': info_name,
+            'source-info-url': info_url or url or EPG_SOURCES[0]
+        }
+
+    def normalize_extras(self):
+        root = self.epg_doc.getroot()
+        attrib = self.normalize_attrib(root.attrib)
+        root.attrib.clear()
+        root.attrib.update(attrib)
 
     def normalize(self):
         self.convert_channel_name()
         self.cleanup()
         self.normalize_extras()
 
-    def dumpb(self):
+    def format_tree(self):
         root = self.epg_doc.getroot()
-        ET.indent(root)
-        return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+        if EPG_INDENT:
+            ET.indent(root)
+        else:
+            strip_whitespace(root)
+        return root
+
+    def dumpb(self):
+        return ET.tostring(self.format_tree(), encoding='utf-8', xml_declaration=True)
 
     def dumps(self):
         return self.dumpb().decode()
 
-    def export_xml(self):
+    @contextmanager
+    def open_export(self):
+        """同时写入 epg.xml 及 epg.xml.gz"""
         dst = self.iptv.get_dist('epg.xml')
-        with open(dst, 'w') as fp:
-            fp.write(self.dumps())
-        logging.info(f'导出xml: {dst}')
+        compress = [f for f in OUTPUT_COMPRESS if f != 'gz']
+        if not EPG_GZ_DISABLED:
+            compress.append('gz')
+        with self.iptv.open_output(dst, compress=compress, gzip_level=EPG_GZ_LEVEL) as fp:
+            yield fp
+        unchanged = '' if fp.changed else ' (未改变)'
+        logging.info(f'导出xml: {dst}{unchanged}')
+        if not EPG_GZ_DISABLED:
+            logging.info(f'导出xml.gz: {dst}.gz{unchanged}')
+        self.iptv.save_output_manifest()
 
-    def export_xml_gz(self):
-        dst = self.iptv.get_dist('epg.xml.gz')
-        with open(dst, 'wb') as fp:
-            fp.write(gzip.compress(self.dumpb()))
-        logging.info(f'导出xml.gz: {dst}')
+    def export(self):
+        with self.open_export() as fp:
+            # 日期属性不参与内容是否改变的判断
+            root = self.format_tree()
+            fp.write_volatile(self.dump_head(root.attrib))
+            fp.write((root.text or '').encode())
+            for ele in root:
+                # 包含其后的缩进
+                fp.write(ET.tostring(ele, encoding='utf-8'))
+            fp.write(b'</tv>')
 
-    def run(self):
-        self.fetch_epg()
-        self.normalize()
-        self.export_xml()
+    def open_epg_stream(self, url):
+        stream = self.open_source(url)
+        logging.info(f'EPG获取成功: {url}')
+        if stream.peek(2)[:2] == b'\x1f\x8b':
+            logging.info('EPG流式解压')
+            stream = gzip.GzipFile(fileobj=stream)
+        return stream
 
-        if not EPG_GZ_DISABLED:
-            self.export_xml_gz()
+    def iterparse(self, stream):
+        """逐个返回根节点属性及其一级子节点, 处理后即释放"""
+        root = None
+        depth = 0
+        for event, ele in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if root is None:
+                    root = ele
+                    yield 'root', dict(ele.attrib)
+                continue
+            depth -= 1
+            if depth == 1:
+                yield ele.tag, ele
+                root.clear()
+
+    def enum_normalized(self, stream):
+        # 流式版本的 convert_channel_name + cleanup + normalize_extras
+        # XMLTV中channel均位于programme之前, 未知频道的节目将被丢弃
+        map_ = self.load_channel_name_map()
+        reserved_channel_ids = {}
+        reserved_channel_names = set()
+        for tag, ele in self.iterparse(stream):
+            if tag == 'root':
+                yield tag, self.normalize_attrib(ele)
+            elif tag == 'channel':
+                name_ele = ele.find('display-name')
+                if name_ele is None:
+                    continue
+                if name_ele.text in map_:
+                    logging.debug(f'映射频道名: {name_ele.text} => {map_[name_ele.text]}')
+                    name_ele.text = map_[name_ele.text]
+                if name_ele.text in self.channels:
+                    reserved_channel_ids[ele.get('id')] = name_ele.text
+                    reserved_channel_names.add(name_ele.text)
+                    yield tag, ele
+            elif tag == 'programme':
+                if ele.get('channel') not in reserved_channel_ids:
+                    continue
+                if not self.filter_programme(ele, ele.get('channel')):
+                    continue
+                if self.index is not None:
+                    self.index.add(reserved_channel_ids[ele.get('channel')], ele)
+                yield tag, ele
+
+        non_existed_channels = ', '.join([n for n in self.channels.keys() if n not in reserved_channel_names])
+        logging.info(f'没有节目表的频道: {non_existed_channels}')
+
+    def dump_element(self, ele):
+        # 序列化根节点的一级子节点, 包含其前的缩进
+        if EPG_INDENT:
+            ET.indent(ele, level=1)
+        else:
+            strip_whitespace(ele)
+        ele.tail = None
+        return (b'\n  ' if EPG_INDENT else b'') + ET.tostring(ele, encoding='utf-8')
+
+    def dump_head(self, attrib):
+        head = ET.tostring(ET.Element('tv', attrib), encoding='utf-8', xml_declaration=True)
+        return head[:-3] + b'>'
+
+    def dump_tail(self):
+        return b'\n</tv>' if EPG_INDENT else b'</tv>'
+
+    def write_stream(self, fp, elements):
+        # 与 export 的输出一致
+        opened = False
+        for tag, ele in elements:
+            if tag == 'root':
+                fp.write_volatile(self.dump_head(ele))
+                opened = True
+                continue
+            fp.write(self.dump_element(ele))
+        if opened:
+            fp.write(self.dump_tail())
+
+    def run_stream(self):
+        url = EPG_SOURCES[0]
+        try:
+            with self.open_epg_stream(url) as stream, self.open_export() as fp:
+                self.write_stream(fp, self.enum_normalized(stream))
+        except Exception as e:
+            logging.error(f'解析EPG出错: {url} {e}')
+            return False
+        return True
+
+    def parse_merge_source(self, index, url, map_):
+        """解析单个源, 所需节目序列化后存入临时文件, 内存中仅保留索引"""
+        source = {
+            'index': index,
+            'url': url,
+            'attrib': None,
+            'channels': {},         # 频道名 => 序列化的channel
+            'programmes': {},       # 频道名 => [(开始, 结束, 偏移, 长度, 标题)]
+            'spool': tempfile.TemporaryFile()
+        }
+        channel_names = {}
+        offset = 0
+        with self.open_epg_stream(url) as stream:
+            for tag, ele in self.iterparse(stream):
+                if tag == 'root':
+                    source['attrib'] = ele
+                elif tag == 'channel':
+                    name_ele = ele.find('display-name')
+                    if name_ele is None:
+                        continue
+                    name = map_.get(name_ele.text, name_ele.text)
+                    if name not in self.channels:
+                        continue
+                    channel_names[ele.get('id')] = name
+                    if name not in source['channels']:
+                        # 多源合并时以频道名作为id
+                        name_ele.text = name
+                        ele.set('id', name)
+                        source['channels'][name] = self.dump_element(ele)
+                elif tag == 'programme':
+                    name = channel_names.get(ele.get('channel'))
+                    if name is None:
+                        continue
+                    start = parse_xmltv_time(ele.get('start', ''))
+                    stop = parse_xmltv_time(ele.get('stop', ''))
+                    if start is None or stop is None or stop <= start:
+                        continue
+                    # 每频道数量限制在合并后处理
+                    if not self.filter_programme(ele):
+                        continue
+                    ele.set('channel', name)
+                    title = ele.find('title')
+                    title = title.text or '' if title is not None else ''
+                    data = self.dump_element(ele)
+                    source['spool'].write(data)
+                    source['programmes'].setdefault(name, []).append((start, stop, offset, len(data), title))
+                    offset += len(data)
+        return source
+
+    def merge_programmes(self, name, sources):
+        # 主源在前, 其它源仅补充不重叠的时段
+        candidates = [s for s in sources if s['programmes'].get(name)]
+        if EPG_MERGE == 'coverage':
+            candidates.sort(key=lambda s: (-sum(p[1] - p[0] for p in s['programmes'][name]), s['index']))
+        if candidates:
+            logging.debug(f'节目表主源: {name} {candidates[0]["url"]}')
+        starts = []
+        merged = []
+        for s in candidates:
+            for start, stop, offset, length, title in sorted(s['programmes'][name]):
+                i = bisect.bisect_left(starts, start)
+                if i > 0 and merged[i - 1][1] > start:
+                    continue
+                if i < len(merged) and merged[i][0] < stop:
+                    continue
+                starts.insert(i, start)
+                merged.insert(i, (start, stop, s, offset, length, title))
+        if EPG_CHANNEL_LIMIT > 0:
+            merged = [p for p in merged if p[1] > self.now][:EPG_CHANNEL_LIMIT]
+        return merged
+
+    def write_merged(self, fp, sources):
+        fp.write_volatile(self.dump_head(self.normalize_attrib(sources[0]['attrib'] or {}, sources[0]['url'])))
+        names = [n for n in self.channels if any(n in s['channels'] for s in sources)]
+        for name in names:
+            fp.write(next(s['channels'][name] for s in sources if name in s['channels']))
+        for name in names:
+            for start, stop, s, offset, length, title in self.merge_programmes(name, sources):
+                s['spool'].seek(offset)
+                fp.write(s['spool'].read(length))
+                if self.index is not None:
+                    self.index.add_programme(name, start, stop, title)
+        fp.write(self.dump_tail())
+
+        non_existed_channels = ', '.join([n for n in self.channels.keys() if n not in names])
+        logging.info(f'没有节目表的频道: {non_existed_channels}')
+
+    def run_merge(self):
+        map_ = self.load_channel_name_map()
+        sources = []
+        with ThreadPoolExecutor(max_workers=len(EPG_SOURCES)) as executor:
+            futures = [executor.submit(self.parse_merge_source, i, url, map_) for i, url in enumerate(EPG_SOURCES)]
+            for url, future in zip(EPG_SOURCES, futures):
+                try:
+                    sources.append(future.result())
+                except Exception as e:
+                    logging.error(f'解析EPG出错: {url} {e}')
+        if not sources:
+            return False
+        try:
+            with self.open_export() as fp:
+                self.write_merged(fp, sources)
+        finally:
+            for s in sources:
+                s['spool'].close()
+        return True
+
+    def export_index(self):
+        if self.index is not None:
+            self.index.export(self.iptv)
+
+    def build(self):
+        with self.iptv.metrics.timer('epg'):
+            if not EPG_STREAM_DISABLED:
+                if len(EPG_SOURCES) > 1:
+                    ok = self.run_merge()
+                else:
+                    ok = self.run_stream()
+                if not ok:
+                    # 错误已记录, 抛出以便以非0状态退出
+                    raise RuntimeError('EPG生成失败')
+                self.export_index()
+            else:
+                self.fetch_epg()
+                if self.epg_doc is None:
+                    raise RuntimeError('EPG获取失败')
+                self.normalize()
+                self.export()
+                self.export_index()
+
+    def run(self):
+        self.build()
+        self.iptv.export_metrics()
+        self.iptv.prune_cache()
 
 
 if __name__ == '__main__':
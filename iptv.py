@@ -1,24 +1,48 @@
 import os
+import sys
 from configparser import ConfigParser, NoOptionError
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import re
 from urllib.parse import urlparse
+import ipaddress
 import logging
 import itertools
 import typing as t
 import json
+import io
+import time
+import hashlib
+import gzip
+import zlib
+import heapq
+import shutil
+import tempfile
+import pickle
+import multiprocessing
 from datetime import datetime
 from itertools import islice
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 import zhconv
 
+from source import parse_source, PARSER_VERSION
+
 DEBUG = os.environ.get('DEBUG') is not None
 IPTV_CONFIG = os.environ.get('IPTV_CONFIG') or 'config.ini'
 IPTV_CHANNEL = os.environ.get('IPTV_CHANNEL') or 'channel.txt'
 IPTV_DIST = os.environ.get('IPTV_DIST') or 'dist'
+IPTV_CACHE = os.environ.get('IPTV_CACHE') or '.cache'
 EXPORT_RAW = ConfigParser.BOOLEAN_STATES[os.environ.get('EXPORT_RAW', default=str(DEBUG)).lower()]
 EXPORT_JSON = ConfigParser.BOOLEAN_STATES[os.environ.get('EXPORT_JSON', default=str(DEBUG)).lower()]
+# 导出运行指标 raw/metrics.json 及 Prometheus文本格式的 raw/metrics.prom
+EXPORT_METRICS = ConfigParser.BOOLEAN_STATES[os.environ.get('EXPORT_METRICS', default='true').lower()]
+# 运行指标的输出目录, 其中的耗时每次都不同, 输出目录需提交时应另行指定
+IPTV_METRICS_DIST = os.environ.get('IPTV_METRICS_DIST') or IPTV_DIST
+# 输出文件的预压缩格式, 逗号分隔, 可选: gz br zst, br及zst需安装brotli/zstandard
+OUTPUT_COMPRESS = [f.strip() for f in os.environ.get('OUTPUT_COMPRESS', 'gz').split(',') if f.strip()]
 
 DEF_LINE_LIMIT = 10
 DEF_REQUEST_TIMEOUT = 100
@@ -27,6 +51,51 @@ DEF_INFO_LINE = 'https://gcalic.v.myalicdn.com/gc/wgw05_1/index.m3u8?contentid=2
 DEF_EPG = 'https://raw.githubusercontent.com/JinnLynn/iptv/dist/epg.xml'
 DEF_IPV4_FILENAME_SUFFIX = '-ipv4'
 DEF_WHITELIST_PRIORITY = 10
+DEF_FETCH_CONCURRENCY = 8
+DEF_CHUNK_SIZE = 64 * 1024
+DEF_CACHE_MAX_AGE = 24 * 7          # 小时
+DEF_CACHE_MAX_SIZE = 512            # MB
+DEF_NAME_CACHE_SIZE = 50000
+# 频道名规范规则版本, 修改clean_channel_name后需递增以使名称缓存失效
+NAME_RULES_VERSION = 1
+# 线路地址规范规则版本, 修改canonicalize_url后需递增以使解析缓存失效
+URL_RULES_VERSION = 2
+# 规范地址时忽略的跟踪参数, 以_结尾的为前缀
+DEF_TRACKING_PARAMS = ['utm_', 'spm', 'fbclid', 'gclid']
+DEF_NORMALIZE_BATCH_SIZE = 2000
+# 限制保留线路数时, 至少为导出数量的倍数, 为IPv4过滤及探测后的重新排序留出余量
+DEF_RETAIN_HEADROOM = 10
+DEF_SOURCE_HISTORY = 20                 # 每个源保留的记录数
+DEF_SOURCE_MIN_SAMPLES = 3              # 计算超时所需的最少成功记录数
+DEF_SOURCE_TIMEOUT_FACTOR = 4           # 超时为响应时间P95的倍数
+DEF_SOURCE_MIN_TIMEOUT = 10             # 秒
+DEF_SOURCE_FAILURE_THRESHOLD = 3        # 连续失败次数达到后熔断
+DEF_SOURCE_BACKOFF = 12                 # 首次熔断时长, 小时, 之后每次失败翻倍
+DEF_SOURCE_BACKOFF_MAX = 24 * 14        # 小时
+DEF_SOURCE_IDLE_RUNS = 3                # 连续无独有线路的次数达到后提示
+
+_re_jap = re.compile(r'[\u3040-\u309F\u30A0-\u30FF\uAC00-\uD7A3]')  # \uAC00-\uD7A3为匹配韩文的，其余为日文
+_re_cctv_subs = [
+    (re.compile(r'-[(HD)0]*'), '', 0),                                 # CCTV-0 CCTV-HD
+    (re.compile(r'(CCTV[1-9][0-9]?[\+K]?).*'), r'\1', 0),
+]
+_re_cetv_subs = [
+    (re.compile(r'[ -][(HD)0]*'), '', 0),
+    (re.compile(r'(CETV[1-4]).*'), r'\1', 0),
+]
+_name_prefixes = ['NewTV', 'CHC', 'iHOT']
+_re_name_prefix_any = re.compile(r'^(?:{})'.format('|'.join(_name_prefixes)), re.IGNORECASE)
+_re_name_prefixes = [(p, re.compile(fr'^{p}', re.IGNORECASE), [
+    (re.compile(f'{p} +'), p, 1),
+    (re.compile(r'(.*) +.*'), r'\1', 0),
+]) for p in _name_prefixes]
+_re_tvb = re.compile(r'^TVB[^s]', re.IGNORECASE)
+_re_uri_suffix = re.compile(r'\$.*$')
+_re_ipv6_netloc = re.compile(r'\[[0-9a-fA-F:]+\]')
+# 形如主机名或IP的名单规则, 可带端口
+# 匹配名单时仅需协议 主机名及端口, 比urlparse快
+_re_url_host = re.compile(r'([a-zA-Z][\w+.-]*)://(?:[^/?#@]*@)?(\[[0-9a-fA-F:.]+\]|[^/?#:]*)(?::(\d+))?')
+_re_host_rule = re.compile(r'(?:(?:[A-Za-z0-9-]+\.)+[A-Za-z]{2,}|\d{1,3}(?:\.\d{1,3}){3}|\[[0-9a-fA-F:]+\])(?::\d+)?')
 
 logging.basicConfig(
     level=logging.DEBUG if DEBUG else logging.INFO,
@@ -75,6 +144,8 @@ class JSONEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, set):
             return list(o)
+        if isinstance(o, Line):
+            return o.to_dict()
         return super().default(o)
 
 def json_dump(obj, fp=None, **kwargs):
@@ -113,7 +184,833 @@ def clean_inline_comment(v):
 
 def is_ipv6(url):
     p = urlparse(url)
-    return re.match(r'\[[0-9a-fA-F:]+\]', p.netloc) is not None
+    return _re_ipv6_netloc.match(p.netloc) is not None
+
+class URLMatcher:
+    """黑白名单匹配, 规则在构造时一次性编译
+
+    每行一条规则, 可在末尾以空格分隔指定权重:
+        example.com             形如主机名或IP时同host:, 否则为地址包含该字符串
+        re:^https?://.*/udp/    正则表达式
+        host:example.com        主机名或其子域名, 可指定端口 host:example.com:8080
+        cidr:10.0.0.0/8         IP网段, 可指定端口 cidr:10.0.0.0/8:8080
+        port:9901               端口
+    """
+    _default_ports = {'http': 80, 'https': 443, 'rtmp': 1935, 'rtsp': 554}
+
+    def __init__(self, rules, default_weight=1):
+        self.default_weight = default_weight
+
+        self._hosts = {}        # 主机 => {端口: 权重}, 端口None为任意
+        self._networks = {}     # (IP版本, 前缀长度) => {网段: {端口: 权重}}
+        self._ports = {}        # 端口 => 权重
+        self._patterns = {}     # 权重 => [子串或编译后的正则]
+        self._checks = []       # [(权重, (子串), [正则])], 权重降序
+
+        for rule in rules:
+            try:
+                self.add(rule)
+            except Exception as e:
+                logging.error(f'名单规则错误: {rule} {e}')
+        self.compile()
+
+    def __len__(self):
+        return (sum(len(v) for v in self._hosts.values()) + sum(len(v) for v in self._networks.values())
+                + len(self._ports) + sum(len(v) for v in self._patterns.values()))
+
+    def _set_weight(self, d, key, weight):
+        d[key] = max(d.get(key, weight), weight)
+
+    def add(self, rule):
+        weight = self.default_weight
+        parts = rule.rsplit(None, 1)
+        if len(parts) == 2 and re.fullmatch(r'-?\d+', parts[1]):
+            rule, weight = parts[0], int(parts[1])
+
+        kind, sep, value = rule.partition(':')
+        if not sep or kind not in ['re', 'host', 'cidr', 'port']:
+            kind, value = 'str', rule
+
+        if kind == 'str' and _re_host_rule.fullmatch(value):
+            # 名单中多为主机名或IP, 按字典查找, 耗时不随规则数增长
+            kind = 'host'
+
+        if kind == 'str':
+            self._patterns.setdefault(weight, []).append(value)
+        elif kind == 're':
+            # 逐条编译, 合并会使全局标记及反向引用出错
+            self._patterns.setdefault(weight, []).append(re.compile(value))
+        elif kind == 'port':
+            self._set_weight(self._ports, int(value), weight)
+        elif kind == 'host':
+            match = re.fullmatch(r'(\[[0-9a-fA-F:]+\]|[^:]+)(?::(\d+))?', value)
+            if not match:
+                raise ValueError('主机格式错误')
+            host = match.group(1).strip('[]').lower()
+            port = int(match.group(2)) if match.group(2) else None
+            self._set_weight(self._hosts.setdefault(host, {}), port, weight)
+        else:
+            match = re.fullmatch(r'(.+/\d+)(?::(\d+))?', value) or re.fullmatch(r'([^/]+)', value)
+            if not match:
+                raise ValueError('网段格式错误')
+            network = ipaddress.ip_network(match.group(1), strict=False)
+            port = int(match.group(2)) if match.lastindex and match.lastindex > 1 and match.group(2) else None
+            ports = self._networks.setdefault((network.version, network.prefixlen), {}).setdefault(network, {})
+            self._set_weight(ports, port, weight)
+
+    def compile(self):
+        self._checks = [(w, tuple(dict.fromkeys(i for i in p if isinstance(i, str))),
+                         [i for i in p if not isinstance(i, str)])
+                        for w, p in sorted(self._patterns.items(), reverse=True)]
+
+    def _match_ports(self, ports, port):
+        weights = [ports[p] for p in (None, port) if p in ports]
+        return max(weights) if weights else None
+
+    def match(self, url):
+        """返回匹配规则中的最大权重, 未匹配返回None"""
+        weights = []
+        if self._hosts or self._networks or self._ports:
+            m = _re_url_host.match(url)
+            scheme, host, port = m.groups() if m else ('', '', None)
+            host = host.strip('[]').lower()
+            port = int(port) if port else self._default_ports.get(scheme.lower())
+
+            if port in self._ports:
+                weights.append(self._ports[port])
+
+            if self._hosts and host:
+                labels = host.split('.')
+                for i in range(len(labels)):
+                    ports = self._hosts.get('.'.join(labels[i:]))
+                    if ports:
+                        weights.append(self._match_ports(ports, port))
+
+            if self._networks and host:
+                try:
+                    ip = ipaddress.ip_address(host)
+                except ValueError:
+                    ip = None
+                if ip is not None:
+                    for (version, prefixlen), networks in self._networks.items():
+                        if version != ip.version:
+                            continue
+                        ports = networks.get(ipaddress.ip_network(f'{ip}/{prefixlen}', strict=False))
+                        if ports:
+                            weights.append(self._match_ports(ports, port))
+
+        weights = [w for w in weights if w is not None]
+        best = max(weights) if weights else None
+        for weight, strs, regexes in self._checks:
+            if best is not None and weight <= best:
+                break
+            if any(s in url for s in strs) or any(r.search(url) for r in regexes):
+                return weight
+        return best
+
+
+class IterStream(io.RawIOBase):
+    """将bytes迭代器包装为可读的二进制流"""
+
+    def __init__(self, iterable, known_hash=None):
+        self._it = iter(iterable)
+        self._buf = b''
+        self._hash = hashlib.sha256()
+        self.bytes_read = 0
+        # 内容的sha256, 读取前已知时(如来自缓存)可据此跳过读取
+        self.known_hash = known_hash
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            while not self._buf:
+                self._buf = next(self._it)
+        except StopIteration:
+            return 0
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._hash.update(self._buf[:n])
+        self._buf = self._buf[n:]
+        self.bytes_read += n
+        return n
+
+    def hexdigest(self):
+        """已读取内容的sha256"""
+        return self._hash.hexdigest()
+
+    def close(self):
+        if hasattr(self._it, 'close'):
+            self._it.close()
+        super().close()
+
+
+class NameCache:
+    """原始频道名 => (映射后名称, 最终名称) 的LRU缓存, 可持久化"""
+
+    def __init__(self, path, key, maxsize=DEF_NAME_CACHE_SIZE):
+        self.path = path
+        self.key = key
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+        self._dirty = False
+
+    def get(self, name):
+        v = self._d.get(name)
+        if v is not None:
+            self._d.move_to_end(name)
+        return v
+
+    def set(self, name, value):
+        self._d[name] = value
+        self._dirty = True
+        if len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def __len__(self):
+        return len(self._d)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if data.get('key') != self.key:
+            logging.debug('频道名规则已改变, 名称缓存失效')
+            return
+        for name, value in islice(data.get('names', {}).items(), self.maxsize):
+            self._d[name] = tuple(value)
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'key': self.key, 'names': self._d}, fp, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+class SourceLedger:
+    """源的健康记录, 保存成功与否 响应时间 大小 独有线路数的历史
+
+    据此调整各源的超时, 连续失败的源熔断一段时间, 熔断期满后重试一次, 再次失败则熔断时长翻倍
+    """
+
+    def __init__(self, path, failure_threshold=DEF_SOURCE_FAILURE_THRESHOLD,
+                 backoff=DEF_SOURCE_BACKOFF, backoff_max=DEF_SOURCE_BACKOFF_MAX):
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff * 3600
+        self.backoff_max = backoff_max * 3600
+        self.sources = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                self.sources = json.load(fp).get('sources', {})
+        except (OSError, ValueError):
+            self.sources = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'sources': self.sources}, fp, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def get(self, url):
+        return self.sources.setdefault(url, {'history': [], 'failures': 0, 'open_until': 0, 'idle_runs': 0})
+
+    def timeout(self, url, default=DEF_REQUEST_TIMEOUT):
+        entry = self.sources.get(url)
+        latencies = sorted(h['latency'] for h in entry['history'] if h['ok']) if entry else []
+        if len(latencies) < DEF_SOURCE_MIN_SAMPLES:
+            return default
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        return round(min(max(p95 * DEF_SOURCE_TIMEOUT_FACTOR, DEF_SOURCE_MIN_TIMEOUT), default), 1)
+
+    def is_open(self, url, now):
+        entry = self.sources.get(url)
+        return entry is not None and entry['open_until'] > now
+
+    def record(self, url, stat, now):
+        entry = self.get(url)
+        # 使用过期缓存的视为失败
+        ok = stat['ok'] and not stat['stale']
+        entry['history'].append({
+            'time': int(now),
+            'ok': ok,
+            'latency': round(stat['latency'], 3) if ok else None,
+            'bytes': stat['bytes'],
+            'unique': stat['unique']
+        })
+        del entry['history'][:-DEF_SOURCE_HISTORY]
+        if ok:
+            entry['failures'] = 0
+            entry['open_until'] = 0
+            entry['idle_runs'] = entry['idle_runs'] + 1 if stat['unique'] == 0 else 0
+        else:
+            entry['failures'] += 1
+            if entry['failures'] >= self.failure_threshold:
+                backoff = self.backoff * 2 ** (entry['failures'] - self.failure_threshold)
+                entry['open_until'] = int(now + min(backoff, self.backoff_max))
+        return entry
+
+    def prune(self, urls):
+        for url in set(self.sources) - set(urls):
+            del self.sources[url]
+
+
+class ParseCache:
+    """各源的解析及规范化结果缓存, 源内容及规范化配置均未改变时直接复用"""
+
+    def __init__(self, path, config_key):
+        self.path = path
+        self.config_key = config_key
+
+    def _path(self, url):
+        return os.path.join(self.path, f'{hashlib.sha1(url.encode()).hexdigest()}.pickle')
+
+    def _key(self, body_hash):
+        return f'{body_hash}:{self.config_key}'
+
+    def get(self, url, body_hash):
+        if not body_hash:
+            return None
+        try:
+            with open(self._path(url), 'rb') as fp:
+                data = pickle.load(fp)
+        except (OSError, pickle.PickleError, EOFError, ValueError):
+            return None
+        return data if data.get('key') == self._key(body_hash) else None
+
+    def set(self, url, body_hash, **kwargs):
+        os.makedirs(self.path, exist_ok=True)
+        dst = self._path(url)
+        tmp = f'{dst}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fp:
+            pickle.dump(dict(kwargs, key=self._key(body_hash)), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, dst)
+
+    def prune(self, urls):
+        if not os.path.isdir(self.path):
+            return
+        keep = {os.path.basename(self._path(u)) for u in urls}
+        for f in os.listdir(self.path):
+            if f not in keep:
+                os.remove(os.path.join(self.path, f))
+
+
+class HTTPCache:
+    """基于ETag/Last-Modified的HTTP条件请求磁盘缓存"""
+
+    def __init__(self, path, max_age=DEF_CACHE_MAX_AGE, max_size=DEF_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_age = max_age * 3600
+        self.max_size = max_size * 1024 * 1024
+
+    def _key_path(self, url, ext):
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.path, key[:2], f'{key}.{ext}')
+
+    def _write(self, dst, data):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f'{dst}.{os.getpid()}.{id(data)}.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, dst)
+
+    def _make_meta(self, url, res, sha256):
+        return {
+            'url': url,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'sha256': sha256,
+            'stored': time.time()
+        }
+
+    def get_meta(self, url):
+        try:
+            with open(self._key_path(url, 'json'), 'rb') as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if meta.get('url') != url or not os.path.isfile(self._key_path(url, 'body')):
+            return None
+        return meta
+
+    def read(self, url):
+        with open(self._key_path(url, 'body'), 'rb') as fp:
+            return fp.read()
+
+    def open_body(self, url):
+        return open(self._key_path(url, 'body'), 'rb')
+
+    def iter_body(self, url, chunk_size=DEF_CHUNK_SIZE):
+        with self.open_body(url) as fp:
+            while chunk := fp.read(chunk_size):
+                yield chunk
+
+    def set(self, url, res):
+        self._write(self._key_path(url, 'body'), res.content)
+        meta = self._make_meta(url, res, hashlib.sha256(res.content).hexdigest())
+        self._write(self._key_path(url, 'json'), json.dumps(meta).encode())
+
+    def iter_store(self, url, res, chunk_size=DEF_CHUNK_SIZE):
+        # 边读取边写入缓存, 完整读取后才生效
+        dst = self._key_path(url, 'body')
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f'{dst}.{os.getpid()}.{id(res)}.tmp'
+        h = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as fp:
+                for chunk in res.iter_content(chunk_size):
+                    fp.write(chunk)
+                    h.update(chunk)
+                    yield chunk
+            os.replace(tmp, dst)
+            meta = self._make_meta(url, res, h.hexdigest())
+            self._write(self._key_path(url, 'json'), json.dumps(meta).encode())
+        finally:
+            res.close()
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def touch(self, url):
+        for ext in ['json', 'body']:
+            try:
+                os.utime(self._key_path(url, ext))
+            except OSError:
+                pass
+
+    def conditional_headers(self, meta):
+        headers = {}
+        if not meta:
+            return headers
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def make_response(self, url, body):
+        res = requests.Response()
+        res.url = url
+        res.status_code = 200
+        res._content = body
+        res._content_consumed = True
+        res.from_cache = True
+        return res
+
+    def prune(self):
+        if not os.path.isdir(self.path):
+            return
+        entries = {}
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                key, _, ext = f.partition('.')
+                st = os.stat(os.path.join(root, f))
+                e = entries.setdefault(key, {'files': [], 'size': 0, 'mtime': 0})
+                e['files'].append(os.path.join(root, f))
+                e['size'] += st.st_size
+                e['mtime'] = max(e['mtime'], st.st_mtime)
+
+        now = time.time()
+        total = 0
+        removed = 0
+        # 最近使用的优先保留
+        for e in sorted(entries.values(), key=lambda i: i['mtime'], reverse=True):
+            if now - e['mtime'] > self.max_age or total + e['size'] > self.max_size:
+                for f in e['files']:
+                    os.remove(f)
+                removed += 1
+                continue
+            total += e['size']
+        logging.debug(f'缓存清理: 移除: {removed} 保留: {len(entries) - removed} 大小: {total}')
+
+
+def compress_brotli(data):
+    import brotli
+    return brotli.compress(data)
+
+def compress_zstd(data):
+    import zstandard
+    return zstandard.ZstdCompressor(level=19).compress(data)
+
+_compressors = {'br': compress_brotli, 'zst': compress_zstd}
+
+
+class OutputManifest:
+    """输出文件清单, 记录各文件的哈希及大小, 供镜像仅同步改变的文件"""
+
+    def __init__(self, dist):
+        self.dist = dist
+        self.path = os.path.join(dist, 'manifest.json')
+        self.files = {}
+        self._dirty = False
+        try:
+            with open(self.path, 'rb') as fp:
+                self.files = json.load(fp).get('files', {})
+        except (OSError, ValueError):
+            pass
+
+    def relpath(self, dst):
+        return os.path.relpath(dst, self.dist).replace(os.sep, '/')
+
+    def get(self, dst):
+        return self.files.get(self.relpath(dst))
+
+    def update(self, dst, **kwargs):
+        self.files[self.relpath(dst)] = kwargs
+        self._dirty = True
+
+    def remove(self, dst):
+        if self.files.pop(self.relpath(dst), None) is not None:
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(self.dist, exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fp:
+            json_dump({'files': dict(sorted(self.files.items()))}, fp)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+class OutputFile:
+    """先写入临时文件再原子替换, 内容未改变时不覆盖, 并生成预压缩副本
+
+    write_volatile 写入的内容(如日期)不参与是否改变的判断
+    """
+
+    def __init__(self, manifest, dst, compress=None, gzip_level=9):
+        self.manifest = manifest
+        self.dst = dst
+        self.compress = OUTPUT_COMPRESS if compress is None else compress
+        self.changed = None
+
+        self._tmps = {dst: f'{dst}.tmp'}
+        self._fp = open(self._tmps[dst], 'wb')
+        self._gz = None
+        if 'gz' in self.compress:
+            self._tmps[f'{dst}.gz'] = f'{dst}.gz.tmp'
+            self._gz = gzip.GzipFile(self._tmps[f'{dst}.gz'], 'wb', compresslevel=gzip_level, mtime=0)
+        self._content_hash = hashlib.sha256()
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self._fp.write(data)
+        if self._gz is not None:
+            self._gz.write(data)
+        return data
+
+    def write(self, data):
+        self._content_hash.update(self._write(data))
+        return len(data)
+
+    def write_volatile(self, data):
+        self._write(data)
+        return len(data)
+
+    def writable(self):
+        return True
+
+    def _discard(self):
+        for tmp in self._tmps.values():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _file_info(self, path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            while chunk := fp.read(DEF_CHUNK_SIZE):
+                h.update(chunk)
+        return {'size': os.path.getsize(path), 'sha256': h.hexdigest()}
+
+    def close(self):
+        self._fp.close()
+        if self._gz is not None:
+            self._gz.close()
+
+        content_hash = self._content_hash.hexdigest()
+        prev = self.manifest.get(self.dst)
+        if prev and prev.get('content') == content_hash and all(os.path.exists(f) for f in self._tmps):
+            self._discard()
+            self.changed = False
+            logging.debug(f'内容未改变, 跳过: {self.dst}')
+            return
+
+        for dst, tmp in self._tmps.items():
+            os.replace(tmp, dst)
+        siblings = [f'{self.dst}.gz'] if self._gz is not None else []
+        for fmt in self.compress:
+            if fmt not in _compressors:
+                continue
+            try:
+                with open(self.dst, 'rb') as fp:
+                    data = _compressors[fmt](fp.read())
+            except ImportError as e:
+                logging.warning(f'压缩格式不可用: {fmt} {e}')
+                continue
+            tmp = f'{self.dst}.{fmt}.tmp'
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, f'{self.dst}.{fmt}')
+            siblings.append(f'{self.dst}.{fmt}')
+
+        self.manifest.update(self.dst, content=content_hash, **self._file_info(self.dst))
+        for sibling in siblings:
+            self.manifest.update(sibling, **self._file_info(sibling))
+        self.changed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self._fp.close()
+            if self._gz is not None:
+                self._gz.close()
+            self._discard()
+            return False
+        self.close()
+        return False
+
+
+class Metrics:
+    """运行指标: 各阶段耗时, 各源及各频道的统计"""
+    # 源中每行线路的处理结果
+    LINE_STATUSES = ['kept', 'duplicated', 'blacklisted', 'unwanted', 'invalid']
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.sources = OrderedDict()
+        self.channels = OrderedDict()
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.monotonic() - start)
+
+    def source(self, url):
+        if url not in self.sources:
+            self.sources[url] = dict({
+                'ok': False, 'error': None, 'skipped': False, 'stale': False, 'cached': False, 'timeout': None,
+                'format': None, 'encoding': None, 'bytes': 0, 'latency': None, 'duration': None,
+                'lines': 0, 'unique': 0
+            }, **{k: 0 for k in self.LINE_STATUSES})
+        return self.sources[url]
+
+    def to_dict(self):
+        sources = OrderedDict()
+        for url, stat in self.sources.items():
+            stat = dict(stat)
+            for k in ['latency', 'duration']:
+                if stat[k] is not None:
+                    stat[k] = round(stat[k], 3)
+            # 重复率: 已有线路占所需频道有效线路的比例
+            accepted = stat['kept'] + stat['duplicated']
+            stat['duplicate_ratio'] = round(stat['duplicated'] / accepted, 4) if accepted else 0
+            sources[url] = stat
+        data = OrderedDict()
+        if self.stages:
+            data['stages'] = OrderedDict((k, round(v, 3)) for k, v in self.stages.items())
+        if sources:
+            data['sources'] = sources
+        if self.channels:
+            data['channels'] = OrderedDict([
+                ('lines', self.channels),
+                ('empty', [k for k, v in self.channels.items() if not v])
+            ])
+        return data
+
+    @staticmethod
+    def merge(prev, data):
+        # IPTV及EPG分别运行时 各自更新所属部分
+        merged = OrderedDict(prev)
+        for k, v in data.items():
+            if k == 'stages':
+                merged[k] = OrderedDict(prev.get(k, {}), **v)
+            else:
+                merged[k] = v
+        return merged
+
+    @staticmethod
+    def to_prometheus(data):
+        def _escape(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = []
+
+        def _metric(name, help_, samples):
+            lines.append(f'# HELP {name} {help_}')
+            lines.append(f'# TYPE {name} gauge')
+            for labels, value in samples:
+                if value is None:
+                    continue
+                labels = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+
+        stages = data.get('stages', {})
+        _metric('iptv_stage_seconds', '各阶段耗时', [({'stage': k}, v) for k, v in stages.items()])
+
+        sources = data.get('sources', {})
+        _metric('iptv_source_up', '源是否获取成功', [({'source': u}, int(s['ok'])) for u, s in sources.items()])
+        _metric('iptv_source_skipped', '源是否因熔断跳过', [({'source': u}, int(s['skipped'])) for u, s in sources.items()])
+        _metric('iptv_source_timeout_seconds', '源的超时设置',
+                [({'source': u}, s['timeout']) for u, s in sources.items()])
+        _metric('iptv_source_bytes', '源的大小', [({'source': u}, s['bytes']) for u, s in sources.items()])
+        _metric('iptv_source_latency_seconds', '源的响应时间',
+                [({'source': u}, s['latency']) for u, s in sources.items()])
+        _metric('iptv_source_duration_seconds', '源的下载及解析耗时',
+                [({'source': u}, s['duration']) for u, s in sources.items()])
+        _metric('iptv_source_parsed_lines', '源中解析出的线路数', [({'source': u}, s['lines']) for u, s in sources.items()])
+        _metric('iptv_source_lines', '源中线路按处理结果的数量',
+                [({'source': u, 'status': k}, s[k]) for u, s in sources.items() for k in Metrics.LINE_STATUSES])
+        _metric('iptv_source_unique_lines', '仅由该源提供的所需频道线路数',
+                [({'source': u}, s['unique']) for u, s in sources.items()])
+        _metric('iptv_source_duplicate_ratio', '源中所需频道线路的重复率',
+                [({'source': u}, s['duplicate_ratio']) for u, s in sources.items()])
+
+        channels = data.get('channels', {})
+        _metric('iptv_channel_lines', '频道的线路数', [({'channel': k}, v) for k, v in channels.get('lines', {}).items()])
+        if channels:
+            _metric('iptv_channels_empty', '没有线路的频道数', [({}, len(channels.get('empty', [])))])
+        return '\n'.join(lines) + '\n'
+
+
+class CanonicalURL(t.NamedTuple):
+    url: str            # 输出的地址
+    canonical: str      # 规范地址
+    key: str            # 去重键
+    ipv6: bool
+
+
+class Line:
+    """频道线路, 数量可达数十万, 使用__slots__减少内存占用"""
+    __slots__ = ('uri', 'priority', 'count', 'ipv6', 'probe')
+
+    def __init__(self, uri, priority, ipv6=False):
+        self.uri = uri
+        self.priority = priority
+        self.count = 1
+        self.ipv6 = ipv6
+        self.probe = None
+
+    def to_dict(self):
+        d = OrderedDict(uri=self.uri, priority=self.priority, count=self.count, ipv6=self.ipv6)
+        if self.probe is not None:
+            d['probe'] = self.probe
+        return d
+
+
+class ExportOptions(t.NamedTuple):
+    limit: int
+    logo_url_prefix: t.Optional[str]
+    cate_logos: t.Dict[str, str]
+    epg: str
+    info_disabled: bool
+    ipv4_version: bool
+
+
+class ExportSink:
+    """导出目标, 由 IPTV.export_to 在一次遍历中依次调用"""
+    filename = None
+    fmt = None
+
+    def __init__(self, iptv, only_ipv4=False):
+        self.iptv = iptv
+        self.options = iptv.export_options
+        self.only_ipv4 = only_ipv4
+        self.dst = iptv.get_dist(self.filename, ipv4_suffix=only_ipv4)
+        self.fp = None
+
+    def open(self):
+        self.fp = self.iptv.open_output(self.dst)
+
+    def start_cate(self, cate):
+        pass
+
+    def add_line(self, cate, name, index, line):
+        pass
+
+    def end_cate(self, cate):
+        pass
+
+    def close(self):
+        self.fp.close()
+        logging.info(f'导出{self.fmt}: {self.dst}{"" if self.fp.changed else " (未改变)"}')
+
+
+class M3UExportSink(ExportSink):
+    filename = 'live.m3u'
+    fmt = 'M3U'
+
+    def open(self):
+        super().open()
+        self.fp.write(f'#EXTM3U x-tvg-url="{self.options.epg}"\n')
+
+    def add_line(self, cate, name, index, line):
+        logo = self.options.cate_logos[cate] if cate in self.options.cate_logos else f'{name}.png'
+        self.fp.write(f'#EXTINF:-1 tvg-id="{index}" tvg-name="{name}" tvg-logo="{self.options.logo_url_prefix}/{logo}" group-title="{cate}",{name}\n')
+        self.fp.write(f'{line.uri}\n')
+
+    def close(self):
+        self.iptv.export_info(fmt='m3u', fp=self.fp)
+        super().close()
+
+
+class TXTExportSink(ExportSink):
+    filename = 'live.txt'
+    fmt = 'TXT'
+
+    def start_cate(self, cate):
+        self.fp.write(f'{cate},#genre#\n')
+
+    def add_line(self, cate, name, index, line):
+        self.fp.write(f'{name},{line.uri}\n')
+
+    def end_cate(self, cate):
+        self.fp.write('\n\n')
+
+    def close(self):
+        self.iptv.export_info(fmt='txt', fp=self.fp)
+        super().close()
+
+
+class JSONExportSink(ExportSink):
+    filename = 'raw/channel.json'
+    fmt = 'JSON'
+
+    def open(self):
+        self.data = OrderedDict()
+
+    def start_cate(self, cate):
+        self.data.setdefault(cate, OrderedDict())
+        for chl_name in self.iptv.channel_cates[cate]:
+            self.data[cate].setdefault(chl_name, [])
+
+    def add_line(self, cate, name, index, line):
+        self.data[cate][name].append(line)
+
+    def close(self):
+        with self.iptv.open_output(self.dst) as fp:
+            fp.write(json_dump(self.data))
+        logging.info(f'导出{self.fmt}: {self.dst}{"" if fp.changed else " (未改变)"}')
+
 
 class IPTV:
     def __init__(self, *args, **kwargs):
@@ -121,11 +1018,34 @@ class IPTV:
         self._channel_map = None
         self._blacklist = None
         self._whitelist = None
-
+        self._blacklist_matcher = None
+        self._whitelist_matcher = None
+        self._session = None
+        self._http_cache = None
+        self._name_cache = None
+        self._export_options = None
+        self._output_manifest = None
+        self._source_ledger = None
+        self._parse_cache = None
+        self._retain_lines = None
+        # 限制保留线路数时: (频道名, 是否IPv6) => [(估计优先级, -序号, 继承的计数, 去重键, 线路)] 的最小堆
+        self._line_heaps = {}
+        self._line_seq = itertools.count()
+        # 获取失败而使用过期缓存的地址
+        self._stale_urls = set()
+        # 源 => 其提供的所需频道线路 (频道名, 去重键)
+        self._source_lines = {}
+        # 原始地址 => CanonicalURL
+        self._url_keys = {}
+
+        self.metrics = Metrics()
         self.raw_config = None
         self.raw_channels = {}
         self.channel_cates = OrderedDict()
         self.channels = {}
+        # 频道线路索引: 频道名 => {去重键: 线路}, 与列表共享同一线路对象
+        self._raw_line_index = {}
+        self._line_index = {}
 
     def get_config(self, key, *convs, default=None):
         if not self.raw_config:
@@ -154,6 +1074,19 @@ class IPTV:
             os.makedirs(os.path.dirname(abspath), exist_ok=True)
         return abspath
 
+    @property
+    def output_manifest(self):
+        if self._output_manifest is None:
+            self._output_manifest = OutputManifest(IPTV_DIST)
+        return self._output_manifest
+
+    def open_output(self, dst, **kwargs):
+        return OutputFile(self.output_manifest, dst, **kwargs)
+
+    def save_output_manifest(self):
+        if self._output_manifest is not None:
+            self._output_manifest.save()
+
     def get_dist(self, filename, ipv4_suffix=False):
         parts = filename.rsplit('.', 1)
         if ipv4_suffix:
@@ -184,6 +1117,44 @@ class IPTV:
             self._whitelist = self.get_config('whitelist', conv_list, default=[])
         return self._whitelist
 
+    @property
+    def name_cache(self):
+        if self._name_cache is None:
+            key = hashlib.sha1(json.dumps([NAME_RULES_VERSION, self.channel_map], sort_keys=True).encode()).hexdigest()
+            self._name_cache = NameCache(os.path.join(IPTV_CACHE, 'names.json'), key)
+            if not self.get_config('cache_disabled', conv_bool, default=False):
+                self._name_cache.load()
+        return self._name_cache
+
+    @property
+    def parse_cache(self):
+        if self._parse_cache is None:
+            if self.get_config('cache_disabled', conv_bool, default=False):
+                self._parse_cache = False
+            else:
+                # 影响规范化结果的配置, 改变后缓存失效
+                config = [PARSER_VERSION, NAME_RULES_VERSION, URL_RULES_VERSION, self.channel_map, self.blacklist,
+                          self.whitelist, sorted(self.channels), EXPORT_RAW]
+                key = hashlib.sha1(json.dumps(config, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+                self._parse_cache = ParseCache(os.path.join(IPTV_CACHE, 'parsed'), key)
+        return self._parse_cache
+
+    def save_name_cache(self):
+        if self._name_cache is not None and not self.get_config('cache_disabled', conv_bool, default=False):
+            self._name_cache.save()
+
+    @property
+    def blacklist_matcher(self):
+        if self._blacklist_matcher is None:
+            self._blacklist_matcher = URLMatcher(self.blacklist)
+        return self._blacklist_matcher
+
+    @property
+    def whitelist_matcher(self):
+        if self._whitelist_matcher is None:
+            self._whitelist_matcher = URLMatcher(self.whitelist, default_weight=DEF_WHITELIST_PRIORITY)
+        return self._whitelist_matcher
+
     def load_channels(self):
         for f in IPTV_CHANNEL.split(','):
             current = ''
@@ -210,54 +1181,320 @@ class IPTV:
         for v in self.channel_cates.values():
             for c in v:
                 self.channels.setdefault(c, [])
+                self._line_index.setdefault(c, {})
+
+    @property
+    def fetch_concurrency(self):
+        return max(self.get_config('fetch_concurrency', int, default=DEF_FETCH_CONCURRENCY), 1)
+
+    @property
+    def session(self):
+        # 共享会话 复用同一主机的keep-alive连接
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.headers['User-Agent'] = DEF_USER_AGENT
+            pool_size = self.fetch_concurrency
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    @property
+    def http_cache(self):
+        if self._http_cache is None:
+            if self.get_config('cache_disabled', conv_bool, default=False):
+                self._http_cache = False
+            else:
+                self._http_cache = HTTPCache(os.path.join(IPTV_CACHE, 'http'),
+                                             max_age=self.get_config('cache_max_age', int, default=DEF_CACHE_MAX_AGE),
+                                             max_size=self.get_config('cache_max_size', int, default=DEF_CACHE_MAX_SIZE))
+        return self._http_cache
+
+    @property
+    def source_ledger(self):
+        if self._source_ledger is None:
+            self._source_ledger = SourceLedger(
+                os.path.join(IPTV_CACHE, 'sources.json'),
+                failure_threshold=self.get_config('source_failure_threshold', int, default=DEF_SOURCE_FAILURE_THRESHOLD),
+                backoff=self.get_config('source_backoff', float, default=DEF_SOURCE_BACKOFF),
+                backoff_max=self.get_config('source_backoff_max', float, default=DEF_SOURCE_BACKOFF_MAX))
+            self._source_ledger.load()
+        return self._source_ledger
+
+    def _request(self, url, stream=False, timeout=DEF_REQUEST_TIMEOUT):
+        # 返回: (响应, 是否应使用缓存)
+        cache = self.http_cache
+        meta = cache.get_meta(url) if cache else None
+        try:
+            res = self.session.get(url, timeout=timeout, stream=stream,
+                                   headers=cache.conditional_headers(meta) if cache else None)
+            if res.status_code == 304 and meta:
+                res.close()
+                logging.debug(f'未改变, 使用缓存: {url}')
+                cache.touch(url)
+                return None, True
+            res.raise_for_status()
+        except Exception as e:
+            if not meta:
+                raise
+            logging.warning(f'获取失败, 使用过期缓存: {url} {e}')
+            self._stale_urls.add(url)
+            return None, True
+        return res, False
 
     def fetch(self, url):
-        headers = {'User-Agent': DEF_USER_AGENT}
-        res = requests.get(url, timeout=DEF_REQUEST_TIMEOUT, headers=headers)
-        res.raise_for_status()
+        res, cached = self._request(url)
+        if cached:
+            return self.http_cache.make_response(url, self.http_cache.read(url))
+        if self.http_cache:
+            self.http_cache.set(url, res)
         return res
 
+    def fetch_stream(self, url, chunk_size=DEF_CHUNK_SIZE, timeout=DEF_REQUEST_TIMEOUT):
+        """流式获取, 返回可读的二进制流, 不会将整个响应读入内存"""
+        res, cached = self._request(url, stream=True, timeout=timeout)
+        known_hash = None
+        if cached:
+            chunks = self.http_cache.iter_body(url, chunk_size)
+            known_hash = (self.http_cache.get_meta(url) or {}).get('sha256')
+        elif self.http_cache:
+            chunks = self.http_cache.iter_store(url, res, chunk_size)
+        else:
+            chunks = res.iter_content(chunk_size)
+        return io.BufferedReader(IterStream(chunks, known_hash), buffer_size=chunk_size)
+
+    def prune_cache(self):
+        if self.http_cache:
+            self.http_cache.prune()
+
+    def spool_stream(self, url, stream):
+        """读取完整内容, 返回可重新读取的二进制文件, 不在内存中保留
+        启用缓存时内容已在读取时写入缓存, 直接打开缓存文件, 否则写入临时文件
+        """
+        with stream:
+            if self.http_cache:
+                if stream.raw.known_hash is None:
+                    while stream.read(DEF_CHUNK_SIZE):
+                        pass
+                return self.http_cache.open_body(url)
+            fp = tempfile.TemporaryFile()
+            try:
+                shutil.copyfileobj(stream, fp, DEF_CHUNK_SIZE)
+                fp.seek(0)
+            except BaseException:
+                fp.close()
+                raise
+            return fp
+
+    def try_fetch_source(self, url):
+        # 仅下载, 在主线程中按源的顺序边读取边解析, 内存不随下载完成的源增长
+        stat = self.metrics.source(url)
+        stat['timeout'] = self.source_ledger.timeout(url)
+        start = time.monotonic()
+        parse_cache = self.parse_cache
+        body = None
+        try:
+            stream = self.fetch_stream(url, timeout=stat['timeout'])
+            stat['latency'] = time.monotonic() - start
+            body_hash = stream.raw.known_hash
+            cached = parse_cache.get(url, body_hash) if parse_cache else None
+            if cached is not None:
+                # 内容未改变, 无需读取及解析
+                stream.close()
+            else:
+                body = self.spool_stream(url, stream)
+                body_hash = body_hash or stream.raw.hexdigest()
+                # 无条件请求支持的源, 内容相同时仍可跳过规范化
+                cached = parse_cache.get(url, body_hash) if parse_cache else None
+                if cached is not None:
+                    body.close()
+                    body = None
+        except Exception as e:
+            stat['error'] = str(e) or e.__class__.__name__
+            return url, None, e
+        finally:
+            stat['duration'] = time.monotonic() - start - (stat['latency'] or 0)
+        stat.update(ok=True, stale=url in self._stale_urls, cached=cached is not None,
+                    bytes=cached['bytes'] if body is None else os.fstat(body.fileno()).st_size)
+        return url, (body, cached, body_hash), None
+
+    def enum_fetched(self, urls, fetcher=None):
+        # 并发获取, 但按urls原顺序返回, 保证优先级及去重结果确定
+        fetcher = fetcher or self.try_fetch_source
+        concurrency = min(self.fetch_concurrency, len(urls))
+        if concurrency <= 1:
+            yield from map(fetcher, urls)
+            return
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(fetcher, u) for u in urls]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                # 中途退出时关闭已下载但未解析的内容, 已解析的重复关闭无影响
+                executor.shutdown(cancel_futures=True)
+                for future in futures:
+                    if future.cancelled():
+                        continue
+                    _, fetched, _ = future.result()
+                    if fetched is not None and fetched[0] is not None:
+                        fetched[0].close()
+
+    @property
+    def normalize_workers(self):
+        workers = self.get_config('normalize_workers', int, default=0)
+        return (os.cpu_count() or 1) if workers < 0 else workers
+
+    def open_normalize_pool(self):
+        if self.normalize_workers <= 1:
+            return None
+        logging.info(f'启用多进程规范化: 进程数: {self.normalize_workers}')
+        # 子进程在获取线程运行期间启动, fork可能复制其持有的锁而死锁, 使用forkserver
+        # 子进程中由初始化函数重新创建实例, 无需继承当前进程的状态
+        return ProcessPoolExecutor(max_workers=self.normalize_workers, initializer=_init_normalize_worker,
+                                   mp_context=multiprocessing.get_context('forkserver'))
+
+    def enum_prepared(self, entries, pool=None):
+        # 返回: (属性, prepare_channel_uri的结果), 多进程时按批次分发, 但仍按原顺序返回
+        # 逐批读取entries, 处理中的批次数有限, 不会将整个源读入内存
+        batch_size = self.get_config('normalize_batch_size', int, default=DEF_NORMALIZE_BATCH_SIZE)
+        entries = iter(entries)
+        batches = iter(lambda: list(islice(entries, batch_size)), [])
+        head = list(islice(batches, 2)) if pool is not None else []
+        if len(head) < 2 or len(head[1]) < batch_size:
+            for name, uri, attrs in itertools.chain(*head, entries):
+                yield attrs, self.prepare_channel_uri(name, uri, attrs)
+            return
+        pending = deque()
+        for batch in itertools.chain(head, batches):
+            pending.append((batch, pool.submit(_prepare_batch, batch)))
+            if len(pending) <= self.normalize_workers * 2:
+                continue
+            yield from self._enum_prepared_batch(*pending.popleft())
+        while pending:
+            yield from self._enum_prepared_batch(*pending.popleft())
+
+    def _enum_prepared_batch(self, batch, future):
+        for (_, _, attrs), prepared in zip(batch, future.result()):
+            if prepared is not None:
+                # 子进程中的名称缓存不会保存, 同步到当前进程
+                key, org_name, name = prepared[:3]
+                self.name_cache.set(key, (org_name, name))
+            yield attrs, prepared
+
+    def parse_source(self, url, fetched, pool=None):
+        body, cached, body_hash = fetched
+        stat = self.metrics.source(url)
+        self._source_lines.setdefault(url, set())
+        if cached is None:
+            with body:
+                fmt, encoding, entries = parse_source(body, attrs=EXPORT_RAW)
+                logging.info(f'获取成功: {fmt} {url}{"" if encoding == "utf-8" else f" ({encoding})"}')
+                # 仅缓存需要的线路, 逐行应用, 解析结果缓存关闭时不保留
+                items = [] if self.parse_cache else None
+                unwanted = 0
+                line_count = 0
+                for attrs, prepared in self.enum_prepared(entries, pool):
+                    line_count += 1
+                    if not EXPORT_RAW and prepared is not None and prepared[2] not in self.channels:
+                        # 未导出RAW时不需要的频道仅计数, 不保留也不缓存
+                        unwanted += 1
+                        continue
+                    attrs = attrs if EXPORT_RAW else None
+                    if items is not None:
+                        items.append((attrs, prepared))
+                    self.apply_prepared(url, prepared, attrs)
+            if items is not None:
+                self.parse_cache.set(url, body_hash, format=fmt, encoding=encoding, bytes=stat['bytes'],
+                                     lines=line_count, unwanted=unwanted, items=items)
+        else:
+            fmt, encoding = cached['format'], cached['encoding']
+            line_count, unwanted = cached['lines'], cached['unwanted']
+            logging.info(f'获取成功: {fmt} {url}{"" if encoding == "utf-8" else f" ({encoding})"} (未改变)')
+            for attrs, prepared in cached['items']:
+                self.apply_prepared(url, prepared, attrs)
+        stat.update(format=fmt, encoding=encoding, lines=line_count)
+        stat['unwanted'] += unwanted
+
+    def apply_prepared(self, url, prepared, attrs=None):
+        status = 'invalid' if prepared is None else self.apply_channel_uri(prepared, attrs)
+        self.metrics.source(url)[status] += 1
+        # 保留线路数有限时, 该线路可能已被淘汰
+        if (status == 'kept' or status == 'duplicated') and prepared[7] in self._line_index[prepared[2]]:
+            self._source_lines[url].add((prepared[2], prepared[7]))
+
+    def stat_sources(self, sources):
+        # 统计各源独有的线路数, 并更新源的健康记录
+        counts = {}
+        for lines in self._source_lines.values():
+            for line in lines:
+                counts[line] = counts.get(line, 0) + 1
+        for url, lines in self._source_lines.items():
+            self.metrics.source(url)['unique'] = sum(1 for line in lines if counts[line] == 1)
+
+        ledger = self.source_ledger
+        now = time.time()
+        idle_sources = []
+        for url in sources:
+            stat = self.metrics.source(url)
+            if stat['skipped']:
+                continue
+            entry = ledger.record(url, stat, now)
+            if entry['open_until'] > now:
+                logging.warning(f'源连续失败{entry["failures"]}次, 熔断至: '
+                                f'{datetime.fromtimestamp(entry["open_until"]).strftime("%Y-%m-%d %H:%M")} {url}')
+            if entry['idle_runs'] >= DEF_SOURCE_IDLE_RUNS:
+                idle_sources.append(url)
+        ledger.prune(sources)
+        ledger.save()
+        if self.parse_cache:
+            self.parse_cache.prune(sources)
+        if idle_sources:
+            logging.warning(f'连续{DEF_SOURCE_IDLE_RUNS}次没有独有线路的源, 可考虑移除: {idle_sources}')
+
     def fetch_sources(self):
         sources = self.get_config('source', conv_list, default=[])
         success_count = 0
         failed_sources = []
+        # 在主线程中初始化, 获取线程中仅读取
+        self.parse_cache
+        now = time.time()
+        skipped_sources = [u for u in sources if self.source_ledger.is_open(u, now)]
         for url in sources:
-            try:
-                res = self.fetch(url)
-            except Exception as e:
-                logging.warning(f'获取失败: {url} {e}')
-                failed_sources.append(url)
-                continue
-            is_m3u = any('#EXTINF' in l.decode() for l in islice(res.iter_lines(), 10))
-            logging.info(f'获取成功: {"M3U" if is_m3u else "TXT"} {url}')
-            success_count = success_count + 1
-
-            cur_cate = None
-
-            for line in res.iter_lines():
-                line = line.decode().strip()
-                if not line:
-                    continue
-
-                if is_m3u:
-                    if line.startswith("#EXTINF"):
-                        match = re.search(r'group-title="(.*?)",(.*)', line)
-                        if match:
-                            cur_cate = match.group(1).strip()
-                            chl_name = match.group(2).strip()
-                    elif not line.startswith("#"):
-                        channel_url = line.strip()
-                        self.add_channel_uri(chl_name, channel_url)
+            self.metrics.source(url)['skipped'] = url in skipped_sources
+        if skipped_sources:
+            logging.warning(f'熔断中, 跳过的源: {skipped_sources}')
+        pool = self.open_normalize_pool()
+        try:
+            waited = time.monotonic()
+            fetching = [u for u in sources if u not in skipped_sources]
+            for url, fetched, err in self.enum_fetched(fetching):
+                # fetch: 等待获取的时间, parse: 各源下载的时间之和, 与fetch重叠
+                self.metrics.add_time('fetch', time.monotonic() - waited)
+                self.metrics.add_time('parse', self.metrics.source(url)['duration'] or 0)
+                if err is None:
+                    try:
+                        with self.metrics.timer('normalize'):
+                            self.parse_source(url, fetched, pool)
+                    except (OSError, EOFError, ValueError, zlib.error) as e:
+                        # 内容损坏(如压缩数据不完整)时同样视为获取失败, 已读取部分的线路仍保留
+                        self.metrics.source(url).update(ok=False, error=str(e) or e.__class__.__name__)
+                        err = e
+                if err is not None:
+                    logging.warning(f'获取失败: {url} {err}')
+                    failed_sources.append(url)
                 else:
-                    if "#genre#" in line:
-                        cur_cate = line.split(",")[0].strip()
-                    elif cur_cate:
-                        match = re.match(r"^(.*?),(.*?)$", line)
-                        if match:
-                            chl_name = match.group(1).strip()
-                            channel_url = match.group(2).strip()
-                            self.add_channel_uri(chl_name, channel_url)
-        logging.info(f'源读取完毕: 成功: {success_count} 失败: {len(failed_sources)}')
+                    success_count = success_count + 1
+                if self.retain_lines:
+                    # 仅保留部分线路时地址缓存不跨源, 内存不随线路总数增长
+                    self._url_keys.clear()
+                waited = time.monotonic()
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.save_name_cache()
+        self.stat_sources(sources)
+        logging.info(f'源读取完毕: 成功: {success_count} 失败: {len(failed_sources)} 跳过: {len(skipped_sources)}')
         if failed_sources:
             logging.warning(f'获取失败的源: {failed_sources}')
         self.stat_fetched_channels()
@@ -281,66 +1518,90 @@ class IPTV:
         return False
 
     def clean_channel_name(self, name):
-        def re_subs(s, *reps):
-            for rep in reps:
-                r = ''
-                c = 0
-                if len(rep) == 1:
-                    p = rep[0]
-                elif len(rep) == 2:
-                    p, r = rep
-                else:
-                    p, r, c = rep
-                s = re.sub(p, r, s, c)
+        def re_subs(s, reps):
+            for p, r, c in reps:
+                s = p.sub(r, s, c)
             return s
-        def any_startswith(s, *args):
-            return any([re.search(fr'^{r}', s, re.IGNORECASE) for r in args])
-
-        def any_in(s, *args):
-            return any(a in s for a in args)
 
         # 繁 => 简
-        jap = re.compile(r'[\u3040-\u309F\u30A0-\u30FF\uAC00-\uD7A3]')  # \uAC00-\uD7A3为匹配韩文的，其余为日文
-        if not jap.search(name):
+        if not _re_jap.search(name):
             name = zhconv.convert(name, 'zh-cn', {'「': '「', '」': '」'})
 
         if name.startswith('CCTV'):
-            name = re_subs(name,
-                                (r'-[(HD)0]*', ),                           # CCTV-0 CCTV-HD
-                                (r'(CCTV[1-9][0-9]?[\+K]?).*', r'\1')
-            )
+            name = re_subs(name, _re_cctv_subs)
             # FIX:
             # CCTV4美洲 ... => CCTV4
         elif name.startswith('CETV'):
-            name = re_subs(name,
-                                (r'[ -][(HD)0]*', ),
-                                (r'(CETV[1-4]).*', r'\1'),
-            )
-        elif any_startswith(name, 'NewTV', 'CHC', 'iHOT'):
-            for p in ['NewTV', 'CHC', 'iHOT']:
-                name = re.sub(fr'^{p}', p, name, 1, re.IGNORECASE)
+            name = re_subs(name, _re_cetv_subs)
+        elif _re_name_prefix_any.search(name):
+            for p, prefix, reps in _re_name_prefixes:
+                name = prefix.sub(p, name, 1)
                 if not name.startswith(p):
                     continue
-                name = re_subs(name,
-                                    (re.compile(f'{p} +'), p, 1),
-                                    (r'(.*) +.*', r'\1')
-                )
-        elif re.match(r'^TVB[^s]', name, re.IGNORECASE):
+                name = re_subs(name, reps)
+        elif _re_tvb.match(name):
             name = name.replace(' ', '')
         return name
 
-    def add_channel_for_debug(self, name, url, org_name, org_url):
+    def canonicalize_url(self, uri):
+        """规范线路地址, 结果按原始地址缓存
+
+        输出的地址仅去除默认端口, 规范地址还会将协议及主机名转为小写, 去除片段 跟踪参数及路径末尾的/,
+        并对参数排序, 用于黑白名单匹配, 去重键在此基础上视同一主机的http及https为相同
+        """
+        cached = self._url_keys.get(uri)
+        if cached is not None:
+            return cached
+
+        p = urlparse(uri)
+        url = uri
+        if self.is_port_necessary(p.scheme, p.netloc):
+            p = p._replace(netloc=p.netloc.rsplit(':', 1)[0])
+            url = p.geturl()
+
+        scheme = p.scheme.lower()
+        userinfo, at, host = p.netloc.rpartition('@')
+        path = p.path.rstrip('/')
+        if p.params:
+            # ;参数 常用于鉴权, 不同时为不同线路
+            path = f'{path};{p.params}'
+        query = p.query
+        if query:
+            params = [q for q in query.split('&') if q and not self.is_tracking_param(q.partition('=')[0])]
+            query = '&'.join(sorted(params))
+        canonical = f'{scheme}://{userinfo}{at}{host.lower()}{path}{"?" if query else ""}{query}'
+        key = canonical[len(scheme) + 1:] if scheme in ['http', 'https'] else canonical
+
+        cached = CanonicalURL(url, canonical, key, _re_ipv6_netloc.match(host) is not None)
+        self._url_keys[uri] = cached
+        return cached
+
+    def is_tracking_param(self, name):
+        name = name.lower()
+        return any(name.startswith(p) if p.endswith('_') else name == p for p in DEF_TRACKING_PARAMS)
+
+    def add_channel_for_debug(self, name, url, org_name, org_url, attrs=None, ipv6=None, key=None):
         if name not in self.raw_channels:
-            self.raw_channels.setdefault(name, OrderedDict(source_names=set(), source_urls=set(), lines=[]))
+            self.raw_channels.setdefault(name, OrderedDict(source_names=set(), source_urls=set(),
+                                                           source_tvg_ids=set(), source_logos=set(), lines=[]))
+            self._raw_line_index[name] = {}
 
         self.raw_channels[name]['source_names'].add(org_name)
         self.raw_channels[name]['source_urls'].add(org_url)
-
-        for u in self.raw_channels[name]['lines']:
-            if u['uri'] == url:
-                u['count'] += u['count'] + 1
-                return
-        self.raw_channels[name]['lines'].append({'uri': url, 'count': 1, 'ipv6': is_ipv6(url)})
+        if attrs:
+            if attrs.get('tvg-id'):
+                self.raw_channels[name]['source_tvg_ids'].add(attrs['tvg-id'])
+            if attrs.get('tvg-logo'):
+                self.raw_channels[name]['source_logos'].add(attrs['tvg-logo'])
+
+        key = url if key is None else key
+        u = self._raw_line_index[name].get(key)
+        if u is not None:
+            u['count'] += u['count'] + 1
+            return
+        u = {'uri': url, 'count': 1, 'ipv6': is_ipv6(url) if ipv6 is None else ipv6}
+        self._raw_line_index[name][key] = u
+        self.raw_channels[name]['lines'].append(u)
 
     def try_map_channel_name(self, name):
         if name in self.channel_map.keys():
@@ -349,93 +1610,189 @@ class IPTV:
             logging.debug(f'映射频道名: {o_name} => {name}')
         return name
 
-    def add_channel_uri(self, name, uri):
-        uri = re.sub(r'\$.*$', '', uri)
+    def normalize_channel_name(self, name):
+        # 返回: (映射后的原始名称, 最终名称)
+        cached = self.name_cache.get(name)
+        if cached is not None:
+            return cached
 
-        name = self.try_map_channel_name(name)
+        org_name = self.try_map_channel_name(name)
 
         # 处理频道名
-        org_name = name
-        name = self.clean_channel_name(name)
-        if org_name != name:
-            logging.debug(f'规范频道名: {org_name} => {name}')
-
-        name = self.try_map_channel_name(name)
-
-        changed = False
-        p = urlparse(uri)
+        cleaned = self.clean_channel_name(org_name)
+        if org_name != cleaned:
+            logging.debug(f'规范频道名: {org_name} => {cleaned}')
+
+        cleaned = self.try_map_channel_name(cleaned)
+        self.name_cache.set(name, (org_name, cleaned))
+        return org_name, cleaned
+
+    def prepare_channel_uri(self, name, uri, attrs=None):
+        """add_channel_uri中仅依赖配置的部分, 不修改频道数据, 可在子进程中执行
+        返回: (规范前的频道名, 映射后的原始名称, 频道名, 原始地址, 线路地址, 优先级, 是否IPv6, 去重键)
+        地址出错时返回None, 优先级为None表示在黑名单中, 未导出RAW时不需要的频道不处理地址
+        """
+        # attrs: 源中的频道属性, 如M3U的tvg-id tvg-name tvg-logo group-title
+        if not name and attrs and attrs.get('tvg-name'):
+            name = attrs['tvg-name'].strip()
+
+        key = name
+        org_name, name = self.normalize_channel_name(name)
+        if not EXPORT_RAW and name not in self.channels:
+            return key, org_name, name, uri, None, None, False, None
+
+        uri = _re_uri_suffix.sub('', uri)
         try:
-            if self.is_port_necessary(p.scheme, p.netloc):
-                changed = True
-                p = p._replace(netloc=p.netloc.rsplit(':', 1)[0])
+            c = self.canonicalize_url(uri)
         except Exception as e:
             logging.debug(f'频道线路地址出错: {name} {uri} {e}')
-            return
+            return None
+
+        priority = None
+        if name in self.channels:
+            if self.is_on_blacklist(c.canonical):
+                logging.debug(f'黑名单忽略: {name} {uri}')
+            else:
+                priority = self.whitelist_priority(c.canonical)
+        return key, org_name, name, uri, c.url, priority, c.ipv6, c.key
 
-        url = p.geturl() if changed else uri
+    def apply_channel_uri(self, prepared, attrs=None):
+        # 返回处理结果, 见 Metrics.LINE_STATUSES
+        _, org_name, name, uri, url, priority, ipv6, url_key = prepared
 
-        self.add_channel_for_debug(name, url, org_name, uri)
+        if EXPORT_RAW:
+            self.add_channel_for_debug(name, url, org_name, uri, attrs, ipv6, url_key)
 
         if name not in self.channels:
-            return
+            return 'unwanted'
+        if priority is None:
+            return 'blacklisted'
+
+        u = self._line_index[name].get(url_key)
+        if u is not None:
+            u.count += 1
+            u.priority = u.count + priority
+            return 'duplicated'
+        error = self.evict_channel_line(name, ipv6) if self.retain_lines else 0
+        # 同一地址可能出现在多个频道及源中, 共享字符串
+        u = Line(sys.intern(url), priority + 1, ipv6)
+        self._line_index[name][url_key] = u
+        self.channels[name].append(u)
+        if self.retain_lines:
+            heapq.heappush(self._line_heaps[(name, ipv6)], (u.priority + error, -next(self._line_seq), error, url_key, u))
+        return 'kept'
 
-        if self.is_on_blacklist(url):
-            logging.debug(f'黑名单忽略: {name} {uri}')
+    @property
+    def retain_lines(self):
+        """每个频道IPv4及IPv6线路各自保留的数量, 0为全部保留"""
+        if self._retain_lines is None:
+            retain = max(self.get_config('retain_lines', int, default=0), 0)
+            limit = self.get_config('limit', int, default=DEF_LINE_LIMIT)
+            minimum = limit * DEF_RETAIN_HEADROOM if limit > 0 else 0
+            if minimum and self.get_config('probe', conv_bool, default=False):
+                candidates = self.get_config('probe_candidates', int, default=limit * 2)
+                minimum = max(minimum, candidates * 2) if candidates > 0 else 0
+            if retain and minimum <= 0:
+                logging.warning(f'导出或探测的线路数不限制, 忽略retain_lines: {retain}')
+                retain = 0
+            elif 0 < retain < minimum:
+                logging.warning(f'retain_lines过小, 调整为: {minimum}')
+                retain = minimum
+            self._retain_lines = retain
+        return self._retain_lines
+
+    def evict_channel_line(self, name, ipv6):
+        """按Space-Saving算法, 已满时淘汰估计计数最低的线路, 返回其估计计数, 由新线路继承
+        估计计数 = 实际计数 + 继承的计数, 仅用于淘汰, 使重复出现的线路能累计计数而不被新线路挤出
+        线路的计数及优先级仍为实际出现的次数, 不含继承的部分, 未满时返回0
+        """
+        heap = self._line_heaps.setdefault((name, ipv6), [])
+        if len(heap) < self.retain_lines:
+            return 0
+        while True:
+            estimate, seq, error, key, u = heap[0]
+            if estimate == u.priority + error:
+                break
+            # 重复出现后优先级已提高, 更新后重新比较
+            heapq.heapreplace(heap, (u.priority + error, seq, error, key, u))
+        heapq.heappop(heap)
+        del self._line_index[name][key]
+        self.channels[name].remove(u)
+        # 各源的独有线路仅统计保留的线路, 内存不随线路总数增长
+        for source_lines in self._source_lines.values():
+            source_lines.discard((name, key))
+        return u.count + error
+
+    def add_channel_uri(self, name, uri, attrs=None):
+        prepared = self.prepare_channel_uri(name, uri, attrs)
+        if prepared is not None:
+            self.apply_channel_uri(prepared, attrs)
+
+    def probe_channels(self):
+        if not self.get_config('probe', conv_bool, default=False):
             return
-
-        priority = DEF_WHITELIST_PRIORITY if self.is_on_whitelist(url) else 0
-        for u in self.channels[name]:
-            if u['uri'] == url:
-                u['count'] = u['count'] + 1
-                u['priority'] = u['count'] + priority
-                return
-        self.channels[name].append({'uri': url, 'priority': priority + 1, 'count': 1, 'ipv6': is_ipv6(url)})
-
-        # if changed:
-        #     logging.debug(f'URL cleaned: {uri} => \n                                              {p.geturl()}')
+        from probe import Prober
+        Prober(self).run()
 
     def sort_channels(self):
         for k in self.channels:
-            self.channels[k].sort(key=lambda i: i['priority'], reverse=True)
+            self.channels[k].sort(key=lambda i: i.priority, reverse=True)
 
     def stat_fetched_channels(self):
-        line_num = sum([len(c) for c in self.channels])
+        line_num = sum([len(c) for c in self.channels.values()])
         logging.info(f'获取的所需: 频道: {len(self.channels)} 线路: {line_num}')
-        # TODO: 输出没有获取到任何线路的频道
+        self.metrics.channels = OrderedDict((k, len(v)) for k, v in self.channels.items())
+        empty_channels = [k for k, v in self.channels.items() if not v]
+        if empty_channels:
+            logging.info(f'没有线路的频道: {", ".join(empty_channels)}')
 
     def is_on_blacklist(self, url):
-        # TODO: 支持regex
-        return any(b in url for b in self.blacklist)
-        # return any(re.search(re.compile(b), url) for b in self.blacklist)
+        return self.blacklist_matcher.match(url) is not None
 
     def is_on_whitelist(self, url):
-        # TODO: 支持regex
-        return any(b in url for b in self.whitelist)
+        return self.whitelist_matcher.match(url) is not None
+
+    def whitelist_priority(self, url):
+        return self.whitelist_matcher.match(url) or 0
 
     def enum_channel_uri(self, name, limit=None, only_ipv4=False):
         if name not in self.channels:
             return []
         if limit is None:
-            limit = self.get_config('limit', int, default=DEF_LINE_LIMIT)
+            limit = self.export_options.limit
         index = 0
         for chl in self.channels[name]:
-            if only_ipv4 and chl['ipv6']:
+            if only_ipv4 and chl.ipv6:
                 continue
             index = index + 1
             if isinstance(limit, int) and limit > 0 and index > limit:
                 return
             yield index, chl
 
+    @property
+    def export_options(self):
+        # 导出期间不变的配置, 仅解析一次
+        if self._export_options is None:
+            self._export_options = ExportOptions(
+                limit=self.get_config('limit', int, default=DEF_LINE_LIMIT),
+                logo_url_prefix=self.get_config('logo_url_prefix', lambda s: s.rstrip('/')),
+                cate_logos=self.cate_logos,
+                epg=self.get_config('epg', default=DEF_EPG),
+                info_disabled=self.get_config('disable_export_info', conv_bool, default=False),
+                ipv4_version=self.get_config('export_ipv4_version', conv_bool, default=False)
+            )
+        return self._export_options
+
     def export_info(self, fmt='m3u', fp=None):
-        if self.get_config('disable_export_info', conv_bool, default=False):
+        options = self.export_options
+        if options.info_disabled:
             return
         day = datetime.now().strftime('%Y-%m-%d')
         url = DEF_INFO_LINE
         output = []
 
         if fmt == 'm3u':
-            logo_url_prefix = self.get_config('logo_url_prefix', lambda s: s.rstrip('/'))
-            output.append(f'#EXTINF:-1 tvg-id="1" tvg-name="{day}" tvg-logo="{logo_url_prefix}/default.png" group-title="更新信息",{day}')
+            output.append(f'#EXTINF:-1 tvg-id="1" tvg-name="{day}" tvg-logo="{options.logo_url_prefix}/default.png" group-title="更新信息",{day}')
             output.append(f'{url}')
         else:
             output.append('更新信息,#genre#')
@@ -443,7 +1800,11 @@ class IPTV:
 
         output = '\n'.join(output)
         if fp:
-            fp.write(output)
+            # 日期不参与内容是否改变的判断
+            if hasattr(fp, 'write_volatile'):
+                fp.write_volatile(output)
+            else:
+                fp.write(output)
         return output
 
     def get_export_filename(self, filename, only_ipv4=False):
@@ -452,76 +1813,120 @@ class IPTV:
             parts[0] = f'{parts[0]}-ipv4'
         return '.'.join(parts)
 
+    def export_to(self, sinks):
+        """遍历一次频道数据, 同时写入所有导出目标"""
+        options = self.export_options
+        limit = options.limit if options.limit > 0 else None
+        groups = [[s for s in sinks if not s.only_ipv4], [s for s in sinks if s.only_ipv4]]
+
+        for sink in sinks:
+            sink.open()
+        for cate, chls in self.channel_cates.items():
+            for sink in sinks:
+                sink.start_cate(cate)
+            for chl_name in chls:
+                # [全部线路, 仅IPv4线路] 的序号
+                indexes = [0, 0]
+                for line in self.channels.get(chl_name, []):
+                    for i, group in enumerate(groups):
+                        if not group or (i == 1 and line.ipv6):
+                            continue
+                        if limit is not None and indexes[i] >= limit:
+                            continue
+                        indexes[i] += 1
+                        for sink in group:
+                            sink.add_line(cate, chl_name, indexes[i], line)
+                    if limit is not None and all(not g or n >= limit for g, n in zip(groups, indexes)):
+                        break
+            for sink in sinks:
+                sink.end_cate(cate)
+        for sink in sinks:
+            sink.close()
+
     def export_m3u(self, only_ipv4=False):
-        dst = self.get_dist('live.m3u', ipv4_suffix=only_ipv4)
-        logo_url_prefix = self.get_config('logo_url_prefix', lambda s: s.rstrip('/'))
-
-        with open(dst, 'w') as fp:
-            fp.write('#EXTM3U x-tvg-url="{}"\n'.format(self.get_config('epg', default=DEF_EPG)))
-            for cate, chls in self.channel_cates.items():
-                for chl_name in chls:
-                    for index, uri in self.enum_channel_uri(chl_name, only_ipv4=only_ipv4):
-                        logo = self.cate_logos[cate] if cate in self.cate_logos else f'{chl_name}.png'
-                        fp.write(f'#EXTINF:-1 tvg-id="{index}" tvg-name="{chl_name}" tvg-logo="{logo_url_prefix}/{logo}" group-title="{cate}",{chl_name}\n')
-                        fp.write('{}\n'.format(uri['uri']))
-            self.export_info(fmt='m3u', fp=fp)
-        logging.info(f'导出M3U: {dst}')
+        self.export_to([M3UExportSink(self, only_ipv4=only_ipv4)])
 
     def export_txt(self, only_ipv4=False):
-        dst = self.get_dist('live.txt', ipv4_suffix=only_ipv4)
-        with open(dst, 'w') as fp:
-            for cate, chls in self.channel_cates.items():
-                fp.write(f'{cate},#genre#\n')
-                for chl_name in chls:
-                    for index, uri in self.enum_channel_uri(chl_name, only_ipv4=only_ipv4):
-                        fp.write('{},{}\n'.format(chl_name, uri['uri']))
-                fp.write('\n\n')
-            self.export_info(fmt='txt', fp=fp)
-        logging.info(f'导出TXT: {dst}')
+        self.export_to([TXTExportSink(self, only_ipv4=only_ipv4)])
 
     def export_json(self, only_ipv4=False):
-        dst = self.get_dist('raw/channel.json', ipv4_suffix=only_ipv4)
-        data = OrderedDict()
-        for cate, chls in self.channel_cates.items():
-            data.setdefault(cate, OrderedDict())
-            for chl_name in chls:
-                data[cate].setdefault(chl_name, [])
-                for index, uri in self.enum_channel_uri(chl_name, only_ipv4=only_ipv4):
-                    data[cate][chl_name].append(uri)
-        with open(dst, 'w') as fp:
-            json_dump(data, fp)
-        logging.info(f'导出JSON: {dst}')
+        self.export_to([JSONExportSink(self, only_ipv4=only_ipv4)])
 
     def export_raw(self):
         dst = self.get_dist('raw/source.json')
-        for k in self.raw_channels:
-            self.raw_channels[k]['lines'].sort(key=lambda i: i['count'], reverse=True)
-        with open(dst, 'w') as fp:
-            json_dump(self.raw_channels, fp)
-        logging.info(f'导出RAW: {dst}')
+        with self.open_output(dst) as fp:
+            # 逐个频道序列化写入, 格式与整体json_dump一致, 避免生成整个文档的字符串
+            fp.write('{')
+            for i, (name, data) in enumerate(self.raw_channels.items()):
+                data['lines'].sort(key=lambda i: i['count'], reverse=True)
+                value = json_dump(data).replace('\n', '\n  ')
+                fp.write(f'{"," if i else ""}\n  {json_dump(name)}: {value}')
+            fp.write('\n}' if self.raw_channels else '}')
+        logging.info(f'导出RAW: {dst}{"" if fp.changed else " (未改变)"}')
+
+    def export_metrics(self):
+        if not EXPORT_METRICS:
+            return
+        if os.path.abspath(IPTV_METRICS_DIST) == os.path.abspath(IPTV_DIST):
+            manifest = self.output_manifest
+        else:
+            manifest = OutputManifest(IPTV_METRICS_DIST)
+        dst = self._get_path(IPTV_METRICS_DIST, 'raw/metrics.json')
+        try:
+            with open(dst, 'rb') as fp:
+                prev = json.load(fp, object_pairs_hook=OrderedDict)
+        except (OSError, ValueError):
+            prev = {}
+        data = Metrics.merge(prev, self.metrics.to_dict())
+        with OutputFile(manifest, dst, compress=[]) as fp:
+            fp.write(json_dump(data))
+        with OutputFile(manifest, self._get_path(IPTV_METRICS_DIST, 'raw/metrics.prom'), compress=[]) as fp:
+            fp.write(Metrics.to_prometheus(data))
+        manifest.save()
+        self.save_output_manifest()
+        logging.info(f'导出指标: {dst}')
 
     def export(self):
         self.sort_channels()
 
-        self.export_m3u()
-        self.export_txt()
-
+        sink_classes = [M3UExportSink, TXTExportSink]
         if EXPORT_JSON:
-            self.export_json()
-
-        if self.get_config('export_ipv4_version', conv_bool, default=False):
-            self.export_m3u(only_ipv4=True)
-            self.export_txt(only_ipv4=True)
-            if EXPORT_JSON:
-                self.export_json(only_ipv4=True)
+            sink_classes.append(JSONExportSink)
+        sinks = [c(self) for c in sink_classes]
+        if self.export_options.ipv4_version:
+            sinks.extend([c(self, only_ipv4=True) for c in sink_classes])
+        self.export_to(sinks)
 
         if EXPORT_RAW:
             self.export_raw()
 
-    def run(self):
-        self.load_channels()
+        self.save_output_manifest()
+
+    def build(self):
         self.fetch_sources()
-        self.export()
+        with self.metrics.timer('probe'):
+            self.probe_channels()
+        with self.metrics.timer('export'):
+            self.export()
+
+    def run(self):
+        with self.metrics.timer('load'):
+            self.load_channels()
+        self.build()
+        self.export_metrics()
+        self.prune_cache()
+
+
+# 多进程规范化的子进程中使用的实例
+_normalize_iptv = None
+
+def _init_normalize_worker():
+    global _normalize_iptv
+    _normalize_iptv = IPTV()
+    _normalize_iptv.load_channels()
+
+def _prepare_batch(entries):
+    return [_normalize_iptv.prepare_channel_uri(*e) for e in entries]
 
 
 if __name__ == '__main__':
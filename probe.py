@@ -0,0 +1,253 @@
+import os
+import time
+import sqlite3
+import threading
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from iptv import logging, IPTV_CACHE, DEF_USER_AGENT, DEF_LINE_LIMIT
+
+DEF_PROBE_CONCURRENCY = 32
+DEF_PROBE_HOST_CONCURRENCY = 2
+DEF_PROBE_TIMEOUT = 5
+DEF_PROBE_BYTES = 256 * 1024
+DEF_PROBE_PLAYLIST_BYTES = 1024 * 1024
+DEF_PROBE_MAX_DEPTH = 3
+DEF_PROBE_FAILED_PENALTY = 100
+DEF_PROBE_BONUS = 10
+DEF_PROBE_GOOD_RATE = 2 * 1024 * 1024       # 字节/秒
+DEF_PROBE_GOOD_TTFB = 3                     # 秒
+DEF_PROBE_TTL = 72                          # 小时, 应明显长于运行间隔
+DEF_PROBE_BUDGET = 2000
+DEF_PROBE_HISTORY = 30                      # 天
+
+class ProbeError(Exception):
+    pass
+
+class ProbeStore:
+    """线路探测结果存储, 以线路地址的去重键为键"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS line (
+                uri TEXT PRIMARY KEY,
+                ok INTEGER NOT NULL,
+                ttfb REAL,
+                rate INTEGER,
+                error TEXT,
+                success INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                probed REAL NOT NULL,
+                last_seen REAL NOT NULL
+            )''')
+
+    def get_many(self, uris):
+        records = {}
+        uris = list(uris)
+        # SQLite默认变量数上限
+        for i in range(0, len(uris), 500):
+            batch = uris[i:i + 500]
+            sql = 'SELECT * FROM line WHERE uri IN ({})'.format(','.join('?' * len(batch)))
+            for row in self.conn.execute(sql, batch):
+                records[row['uri']] = dict(row)
+        return records
+
+    def update(self, uri, result, now):
+        # 仅在成功时更新ttfb及速率, 保留最近一次成功的测量值
+        self.conn.execute('''
+            INSERT INTO line (uri, ok, ttfb, rate, error, success, total, probed, last_seen)
+            VALUES (:uri, :ok, :ttfb, :rate, :error, :ok, 1, :now, :now)
+            ON CONFLICT(uri) DO UPDATE SET
+                ok = excluded.ok,
+                ttfb = COALESCE(excluded.ttfb, ttfb),
+                rate = COALESCE(excluded.rate, rate),
+                error = excluded.error,
+                success = success + excluded.ok,
+                total = total + 1,
+                probed = excluded.probed,
+                last_seen = excluded.last_seen
+            ''', dict(result, uri=uri, ok=int(result['ok']), now=now))
+        return self.get_many([uri])[uri]
+
+    def touch(self, uris, now):
+        self.conn.executemany('UPDATE line SET last_seen = ? WHERE uri = ?', [(now, u) for u in uris])
+
+    def expire(self, before):
+        return self.conn.execute('DELETE FROM line WHERE last_seen < ?', (before, )).rowcount
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class Prober:
+    def __init__(self, iptv, *args, **kwargs):
+        self.iptv = iptv
+
+        self.concurrency = iptv.get_config('probe_concurrency', int, default=DEF_PROBE_CONCURRENCY)
+        self.host_concurrency = iptv.get_config('probe_host_concurrency', int, default=DEF_PROBE_HOST_CONCURRENCY)
+        self.timeout = iptv.get_config('probe_timeout', float, default=DEF_PROBE_TIMEOUT)
+        self.probe_bytes = iptv.get_config('probe_bytes', int, default=DEF_PROBE_BYTES)
+        self.ttl = iptv.get_config('probe_ttl', float, default=DEF_PROBE_TTL) * 3600
+        self.budget = iptv.get_config('probe_budget', int, default=DEF_PROBE_BUDGET)
+
+        self._session = None
+        self._host_locks = {}
+        self._host_locks_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.headers['User-Agent'] = DEF_USER_AGENT
+            adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.host_concurrency)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def host_lock(self, url):
+        netloc = urlparse(url).netloc.lower()
+        with self._host_locks_lock:
+            if netloc not in self._host_locks:
+                self._host_locks[netloc] = threading.BoundedSemaphore(max(self.host_concurrency, 1))
+            return self._host_locks[netloc]
+
+    def read(self, url, limit):
+        # 返回: 最终地址, 首字节时间, 内容, 读取耗时
+        with self.host_lock(url):
+            start = time.monotonic()
+            with self.session.get(url, timeout=self.timeout, stream=True) as res:
+                res.raise_for_status()
+                ttfb = None
+                chunks = []
+                size = 0
+                for chunk in res.iter_content(chunk_size=16 * 1024):
+                    if ttfb is None:
+                        ttfb = time.monotonic() - start
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= limit or time.monotonic() - start > self.timeout * 2:
+                        break
+                elapsed = time.monotonic() - start
+                if ttfb is None:
+                    raise ProbeError('空响应')
+                return res.url, ttfb, b''.join(chunks), elapsed - ttfb
+
+    def parse_playlist(self, url, content):
+        # 返回: (是否为主播放列表, 首个子地址)
+        is_master = b'#EXT-X-STREAM-INF' in content
+        for line in content.decode(errors='ignore').splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                return is_master, urljoin(url, line)
+        return is_master, None
+
+    def is_probeable(self, uri):
+        return urlparse(uri).scheme in ['http', 'https']
+
+    def probe(self, uri):
+        result = {'ok': False, 'ttfb': None, 'rate': None, 'error': None}
+        try:
+            url = uri
+            for _ in range(DEF_PROBE_MAX_DEPTH):
+                url, ttfb, content, elapsed = self.read(url, DEF_PROBE_PLAYLIST_BYTES)
+                if result['ttfb'] is None:
+                    result['ttfb'] = round(ttfb, 3)
+                if not content.lstrip().startswith(b'#EXTM3U'):
+                    # 非m3u8 直接视为媒体流
+                    segment = None
+                    break
+                is_master, segment = self.parse_playlist(url, content)
+                if segment is None:
+                    raise ProbeError('播放列表为空')
+                if not is_master:
+                    break
+                url = segment
+            else:
+                raise ProbeError('播放列表嵌套过深')
+
+            if segment is not None:
+                _, _, content, elapsed = self.read(segment, self.probe_bytes)
+            result['rate'] = int(len(content) / elapsed) if elapsed > 0 else len(content)
+            result['ok'] = True
+        except Exception as e:
+            result['error'] = str(e) or e.__class__.__name__
+        return result
+
+    def score(self, result):
+        # 按历史成功率 在最近一次成功的测量得分与失败惩罚间取值
+        ok_score = 0
+        if result['rate'] is not None and result['ttfb'] is not None:
+            rate_score = min(result['rate'] / DEF_PROBE_GOOD_RATE, 1)
+            ttfb_score = max(1 - result['ttfb'] / DEF_PROBE_GOOD_TTFB, 0)
+            ok_score = DEF_PROBE_BONUS * (rate_score + ttfb_score) / 2
+        success_rate = result['success_rate']
+        return round(success_rate * ok_score - (1 - success_rate) * DEF_PROBE_FAILED_PENALTY, 2)
+
+    def make_result(self, record):
+        return {
+            'ok': bool(record['ok']),
+            'ttfb': record['ttfb'],
+            'rate': record['rate'],
+            'error': record['error'],
+            'success_rate': round(record['success'] / record['total'], 3) if record['total'] else 0,
+            'probed': int(record['probed'])
+        }
+
+    def enum_candidates(self):
+        # 每个频道仅探测当前优先级靠前的线路
+        limit = self.iptv.get_config('limit', int, default=DEF_LINE_LIMIT)
+        candidates = self.iptv.get_config('probe_candidates', int, default=limit * 2 if limit > 0 else 0)
+        for lines in self.iptv.channels.values():
+            lines = sorted(lines, key=lambda i: i.priority, reverse=True)
+            yield from lines[:candidates] if candidates > 0 else lines
+
+    def run(self):
+        # 以规范地址的去重键记录探测结果, 仅在协议 参数顺序等方面不同的线路共享结果
+        lines = {}
+        targets = {}
+        for line in self.enum_candidates():
+            key = self.iptv.canonicalize_url(line.uri).key
+            lines.setdefault(key, []).append(line)
+            targets.setdefault(key, line.uri)
+
+        keys = [k for k, u in targets.items() if self.is_probeable(u)]
+        now = time.time()
+        store = ProbeStore(os.path.join(IPTV_CACHE, 'probe.db'))
+        records = store.get_many(keys)
+
+        # 仅探测新线路及过期线路, 最久未探测的优先
+        pending = [k for k in keys if k not in records or now - records[k]['probed'] > self.ttl]
+        pending.sort(key=lambda k: records[k]['probed'] if k in records else 0)
+        if self.budget > 0:
+            pending = pending[:self.budget]
+
+        logging.info(f'开始探测线路: {len(pending)} 复用结果: {len(keys) - len(pending)}')
+        stat = {'ok': 0, 'failed': 0}
+        with ThreadPoolExecutor(max_workers=max(self.concurrency, 1)) as executor:
+            for key, result in zip(pending, executor.map(self.probe, [targets[k] for k in pending])):
+                stat['ok' if result['ok'] else 'failed'] += 1
+                records[key] = store.update(key, result, now)
+                logging.debug(f'探测线路: {targets[key]} {result}')
+
+        store.touch(keys, now)
+        expired = store.expire(now - DEF_PROBE_HISTORY * 86400)
+        store.commit()
+        store.close()
+
+        for key in keys:
+            if key not in records:
+                continue
+            result = self.make_result(records[key])
+            score = self.score(result)
+            for line in lines[key]:
+                line.probe = result
+                line.priority += score
+        logging.info(f'探测完毕: 成功: {stat["ok"]} 失败: {stat["failed"]} 未探测: {len(lines) - len(records)} 过期记录: {expired}')
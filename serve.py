@@ -0,0 +1,175 @@
+import os
+import re
+import gzip
+import time
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from iptv import IPTV_DIST, logging
+from build import build
+
+SERVE_HOST = os.environ.get('SERVE_HOST') or '0.0.0.0'
+SERVE_PORT = int(os.environ.get('SERVE_PORT') or 8000)
+# 后台重新生成的间隔, 秒, 0为不重新生成仅提供现有文件
+SERVE_REFRESH = int(os.environ.get('SERVE_REFRESH') or 6 * 3600)
+
+_content_types = {
+    '.m3u': 'audio/x-mpegurl; charset=utf-8',
+    '.txt': 'text/plain; charset=utf-8',
+    '.xml': 'application/xml; charset=utf-8',
+    '.json': 'application/json; charset=utf-8',
+    '.gz': 'application/gzip',
+    '.png': 'image/png',
+}
+_compressed_exts = ('.gz', '.br', '.zst')
+_re_range = re.compile(r'bytes=(\d*)-(\d*)$')
+
+class Resource:
+    __slots__ = ('body', 'gz_body', 'etag', 'gz_etag', 'content_type', 'last_modified')
+
+    def __init__(self, body, gz_body, content_type, last_modified):
+        self.body = body
+        self.gz_body = gz_body
+        self.etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        # 不同编码的内容使用不同的强ETag
+        self.gz_etag = '"{}-gz"'.format(self.etag[1:-1]) if gz_body is not None else None
+        self.content_type = content_type
+        self.last_modified = last_modified
+
+def load_snapshot(dist):
+    """读取dist中的所有文件, 返回 路径 => Resource"""
+    files = {}
+    if not os.path.isdir(dist):
+        return {}
+    for root, _, filenames in os.walk(dist):
+        for f in filenames:
+            path = os.path.join(root, f)
+            key = '/' + os.path.relpath(path, dist).replace(os.sep, '/')
+            if f.endswith('.tmp') or key.startswith('/.git/'):
+                continue
+            with open(path, 'rb') as fp:
+                files[key] = fp.read()
+
+    snapshot = {}
+    last_modified = formatdate(time.time(), usegmt=True)
+    for key, body in files.items():
+        gz_body = None
+        if not key.endswith(_compressed_exts):
+            # 优先使用预压缩副本, 与其自身的路径共享同一份内容
+            gz_body = files.get(f'{key}.gz') or gzip.compress(body, mtime=0)
+            if len(gz_body) >= len(body):
+                gz_body = None
+        content_type = _content_types.get(os.path.splitext(key)[1], 'application/octet-stream')
+        snapshot[key] = Resource(body, gz_body, content_type, last_modified)
+    return snapshot
+
+class Server:
+    def __init__(self, dist=IPTV_DIST, refresh=SERVE_REFRESH):
+        self.dist = dist
+        self.refresh = refresh
+        # 仅整体替换, 读取时无需加锁
+        self.snapshot = load_snapshot(dist)
+        logging.info(f'加载文件: {len(self.snapshot)}')
+
+    def build(self):
+        start = time.monotonic()
+        try:
+            build()
+        except Exception as e:
+            logging.error(f'生成出错: {e}')
+        snapshot = load_snapshot(self.dist)
+        if snapshot:
+            self.snapshot = snapshot
+        logging.info(f'重新生成完毕: 文件: {len(snapshot)} 耗时: {time.monotonic() - start:.1f}s')
+
+    def refresh_forever(self):
+        while True:
+            self.build()
+            time.sleep(self.refresh)
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            server_version = 'iptv'
+
+            def log_message(self, format, *args):
+                logging.debug(f'{self.address_string()} {format % args}')
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                res = server.snapshot.get(self.path.split('?', 1)[0])
+                if res is None:
+                    return self.send_body(404, b'Not Found', 'text/plain', head=head)
+
+                range_ = self.headers.get('Range')
+                use_gz = (res.gz_body is not None and not range_
+                          and 'gzip' in self.headers.get('Accept-Encoding', ''))
+                body, etag = (res.gz_body, res.gz_etag) if use_gz else (res.body, res.etag)
+
+                headers = {
+                    'ETag': etag,
+                    'Last-Modified': res.last_modified,
+                    'Cache-Control': 'no-cache',
+                    'Accept-Ranges': 'bytes',
+                    'Vary': 'Accept-Encoding',
+                }
+                if use_gz:
+                    headers['Content-Encoding'] = 'gzip'
+
+                inm = self.headers.get('If-None-Match')
+                if inm and (inm.strip() == '*' or etag in [t.strip() for t in inm.split(',')]):
+                    return self.send_body(304, b'', None, headers, head=True)
+
+                if range_:
+                    if_range = self.headers.get('If-Range')
+                    if not if_range or if_range.strip() == etag:
+                        return self.send_range(range_, body, res.content_type, headers, head)
+                self.send_body(200, body, res.content_type, headers, head=head)
+
+            def send_range(self, range_, body, content_type, headers, head):
+                m = _re_range.match(range_.strip())
+                size = len(body)
+                if not m or not (m.group(1) or m.group(2)):
+                    return self.send_body(200, body, content_type, headers, head=head)
+                if m.group(1):
+                    start = int(m.group(1))
+                    end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+                else:
+                    start = max(size - int(m.group(2)), 0)
+                    end = size - 1
+                if start >= size or start > end:
+                    headers['Content-Range'] = f'bytes */{size}'
+                    return self.send_body(416, b'', None, headers, head=head)
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+                self.send_body(206, body[start:end + 1], content_type, headers, head=head)
+
+            def send_body(self, code, body, content_type, headers=None, head=False):
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                if content_type:
+                    self.send_header('Content-Type', content_type)
+                if code != 304:
+                    self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+        return Handler
+
+    def serve_forever(self, host=SERVE_HOST, port=SERVE_PORT):
+        if self.refresh > 0:
+            threading.Thread(target=self.refresh_forever, daemon=True).start()
+        httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        logging.info(f'服务已启动: http://{host}:{port}')
+        httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    Server().serve_forever()
@@ -0,0 +1,145 @@
+import io
+import re
+import gzip
+import codecs
+
+DEF_SNIFF_SIZE = 16 * 1024
+# 解析规则改变时递增, 使解析结果缓存失效
+PARSER_VERSION = 2
+# 非UTF-8且无BOM时使用的编码, 兼容GBK/GB2312
+DEF_FALLBACK_ENCODING = 'gb18030'
+
+# UTF-32的BOM以UTF-16的BOM开头, 需优先判断
+_boms = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+_re_m3u_attr = re.compile(r'([\w-]+)="(.*?)"')
+
+
+def detect_encoding(prefix):
+    for bom, encoding in _boms:
+        if prefix.startswith(bom):
+            return encoding
+    try:
+        # 前缀可能在多字节字符中间截断, 仅校验完整部分
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        return DEF_FALLBACK_ENCODING
+    return 'utf-8'
+
+
+class SourceParser:
+    """直播源解析器, 逐行解析, 返回 (频道名, 线路地址, 属性)
+
+    attrs为False时仅在需要时(如M3U无频道名时取tvg-name)生成属性, 其余为None
+    """
+    fmt = None
+
+    def __init__(self, attrs=True):
+        self.attrs = attrs
+
+    @classmethod
+    def sniff(cls, head):
+        return False
+
+    def parse(self, lines):
+        raise NotImplementedError
+
+
+class M3USourceParser(SourceParser):
+    fmt = 'M3U'
+
+    @classmethod
+    def sniff(cls, head):
+        return head.lstrip().startswith('#EXTM3U') or '#EXTINF' in head
+
+    def parse_extinf(self, line):
+        # #EXTINF:-1 tvg-id="" tvg-name="" tvg-logo="" group-title="",频道名
+        # 频道名为最后一个属性之后首个逗号后的内容, 其中可包含引号
+        attrs = {} if self.attrs else None
+        end = 0
+        for m in _re_m3u_attr.finditer(line):
+            if attrs is not None:
+                attrs[m.group(1)] = m.group(2)
+            end = m.end()
+        _, _, name = line[end:].partition(',')
+        name = name.strip()
+        if not name and attrs is None:
+            # 无频道名时使用tvg-name
+            attrs = dict(m.groups() for m in _re_m3u_attr.finditer(line))
+        return name, attrs
+
+    def parse(self, lines):
+        name = None
+        attrs = None
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXTINF'):
+                name, attrs = self.parse_extinf(line)
+            elif not line.startswith('#') and name is not None:
+                # 同一#EXTINF后的多个地址均属于该频道
+                yield name, line, attrs
+
+
+class TXTSourceParser(SourceParser):
+    fmt = 'TXT'
+
+    @classmethod
+    def sniff(cls, head):
+        return '#genre#' in head
+
+    def parse(self, lines):
+        cate = None
+        attrs = None
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if '#genre#' in line:
+                cate = line.split(',')[0].strip()
+                # 同一分类的线路共享属性
+                attrs = {'group-title': cate} if self.attrs else None
+            elif cate:
+                name, sep, uri = line.partition(',')
+                if sep:
+                    yield name.strip(), uri.strip(), attrs
+
+
+# 按顺序嗅探, 均不匹配时使用最后一个
+SOURCE_PARSERS = [M3USourceParser, TXTSourceParser]
+
+
+def sniff_parser(head):
+    for cls in SOURCE_PARSERS:
+        if cls.sniff(head):
+            return cls
+    return SOURCE_PARSERS[-1]
+
+
+def open_source(stream, sniff_size=DEF_SNIFF_SIZE, attrs=True):
+    """从二进制流中嗅探压缩/编码/格式, 返回: (解析器, 文本流)
+    仅预读缓冲区中的前缀, 之后按块解码, 不会将整个内容读入内存
+    """
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=stream), buffer_size=sniff_size)
+    prefix = stream.peek(sniff_size)[:sniff_size]
+    encoding = detect_encoding(prefix)
+    head = prefix.decode(encoding, errors='ignore')
+    text = io.TextIOWrapper(stream, encoding=encoding, errors='replace')
+    return sniff_parser(head)(attrs), text
+
+
+def parse_source(stream, attrs=True):
+    """返回: (格式, 编码, (频道名, 线路地址, 属性)的迭代器)"""
+    parser, text = open_source(stream, attrs=attrs)
+
+    def _iter():
+        with text:
+            yield from parser.parse(text)
+    return parser.fmt, text.encoding, _iter()